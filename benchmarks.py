@@ -0,0 +1,246 @@
+"""
+Benchmarks for the lolviz entry points on large synthetic structures.
+Each benchmark times three phases separately: building the object graph
+(where the function has one), emitting the DOT source and laying it out
+with graphviz (skipped if dot isn't installed). It also records the
+size of the DOT. Run it like this:
+
+    $ python benchmarks.py                  # all benchmarks
+    $ python benchmarks.py objviz --quick   # names containing "objviz", small sizes
+    $ python benchmarks.py --json new.json --compare old.json
+
+Use --compare with the JSON from an earlier run to print each timing
+and DOT size as a ratio of the old one, so regressions show up as numbers.
+"""
+from __future__ import print_function
+import argparse
+import json
+import sys
+import timeit
+
+from lolviz import *
+
+
+class Node:
+    def __init__(self, value, next=None):
+        self.value = value
+        self.next = next
+
+
+class Tree:
+    def __init__(self, value, left=None, right=None):
+        self.value = value
+        self.left = left
+        self.right = right
+
+
+class NaryTree:
+    def __init__(self, value, children=()):
+        self.value = value
+        self.children = list(children)
+
+
+# Workload generators
+
+def linked_list(n):
+    head = None
+    for i in range(n):
+        head = Node(i, head)
+    return head
+
+
+def binary_tree(depth, value=0):
+    if depth == 0:
+        return None
+    return Tree(value, binary_tree(depth-1, 2*value+1), binary_tree(depth-1, 2*value+2))
+
+
+def wide_tree(width, depth):
+    if depth == 0:
+        return NaryTree(0)
+    return NaryTree(depth, [wide_tree(width, depth-1) for i in range(width)])
+
+
+def hash_buckets(nbuckets, n):
+    """A hash table as a list of lists of (key, value) pairs"""
+    table = [[] for i in range(nbuckets)]
+    for i in range(n):
+        key = 'key%d' % i
+        table[hash(key) % nbuckets].append((key, i))
+    return table
+
+
+def big_dict(n):
+    return dict(('key%d' % i, i) for i in range(n))
+
+
+def deep_stack(depth, f):
+    """Call f(frame) from depth nested calls deep, with locals in every frame"""
+    data = [depth, 'frame%d' % depth]
+    if depth == 0:
+        return f(sys._getframe())
+    return deep_stack(depth-1, f)
+
+
+# Measurement
+
+def best(f, repeat):
+    """Return (best time in seconds, result) of repeat calls to f()"""
+    times = []
+    for i in range(repeat):
+        start = timeit.default_timer()
+        result = f()
+        times.append(timeit.default_timer() - start)
+    return min(times), result
+
+
+def layout(source, repeat):
+    try:
+        t, _ = best(lambda: dot_pipe(lambda w: w.write(source), format='svg'), repeat)
+        return t
+    except OSError: # no dot executable
+        return None
+
+
+def measure(name, size, build, emit, repeat, dolayout):
+    """
+    Time build() and emit(graph) where graph is what build() returned.
+    If build is None, emit(None) does all the work and there is no build phase.
+    """
+    if build is not None:
+        build_time, graph = best(build, repeat)
+    else:
+        build_time, graph = None, None
+    emit_time, source = best(lambda: emit(graph), repeat)
+    layout_time = layout(source, 1) if dolayout else None
+    return {'name': name, 'size': size, 'build': build_time, 'emit': emit_time,
+            'layout': layout_time, 'dot_bytes': len(source.encode('utf-8'))}
+
+
+def objgraph(roots, max_nodes=None, max_depth=None):
+    graph = ObjGraph(max_nodes=max_nodes, max_depth=max_depth)
+    for p in roots:
+        graph.add(p)
+    return graph
+
+
+def benchmarks(scale):
+    """Yield (name, size, build, emit) for every benchmark; scale shrinks the workloads"""
+    n = lambda x: max(1, int(x*scale))
+
+    big = list(range(n(1000000)))
+    yield 'listviz ints', len(big), None, lambda _: dot_source(write_listviz, big)
+    words = ['word%d' % i for i in range(n(100000))]
+    yield 'listviz strs', len(words), None, lambda _: dot_source(write_listviz, words)
+
+    for nbuckets in (n(100), n(2000)):
+        table = hash_buckets(nbuckets, 5*nbuckets)
+        yield 'lolviz buckets', nbuckets, None, lambda _, table=table: dot_source(write_lolviz, table)
+
+    full = scale >= 1
+    root = binary_tree(12 if full else 9)
+    yield 'treeviz binary', len(closure(root)), lambda: objgraph([root]), \
+        lambda graph: dot_source(write_treegraph, graph)
+
+    head = linked_list(n(20000))
+    yield 'objviz linked list', n(20000), lambda: objgraph([head]), \
+        lambda graph: dot_source(write_objgraph, graph)
+    longhead = linked_list(n(1000000))
+    yield 'objviz linked list max_nodes=500', n(1000000), lambda: objgraph([longhead], max_nodes=500), \
+        lambda graph: dot_source(write_objgraph, graph)
+    deep = binary_tree(14 if full else 11)
+    yield 'objviz deep tree', len(closure(deep)), lambda: objgraph([deep]), \
+        lambda graph: dot_source(write_objgraph, graph)
+    wide = wide_tree(n(40), 2)
+    yield 'objviz wide tree', len(closure(wide)), lambda: objgraph([wide]), \
+        lambda graph: dot_source(write_objgraph, graph)
+    table = hash_buckets(n(500), n(2500))
+    yield 'objviz buckets', n(500), lambda: objgraph([table]), \
+        lambda graph: dot_source(write_objgraph, graph)
+    d = big_dict(n(100000))
+    yield 'objviz dict', len(d), lambda: objgraph([d]), \
+        lambda graph: dot_source(write_objgraph, graph)
+
+    depth = n(200)
+    results = []
+    def stack(frame):
+        callstack = []
+        while frame.f_code is deep_stack.__code__: # leave out the benchmark's own frames
+            callstack.insert(0, frame)
+            frame = frame.f_back
+        def build():
+            graph = ObjGraph(caller=frame)
+            for f in callstack:
+                graph.add(f)
+            return graph, [graph.index[id(f)] for f in callstack]
+        results.append(('callsviz deep stack', depth, build,
+                        lambda graph: dot_source(write_stack_graph, *graph)))
+    deep_stack(depth, stack)
+    for result in results: # frames stay alive, holding their locals
+        yield result
+
+    try:
+        import numpy as np
+    except ImportError:
+        return
+    wide_array = np.random.rand(n(1000), n(10000))
+    yield 'matrixviz wide ndarray', wide_array.size, None, lambda _: dot_source(write_matrixviz, wide_array)
+    cube = np.arange(n(100)*n(100)*n(100)*10).reshape(n(100), n(100), n(100), 10)
+    yield 'matrixviz 4-d ndarray', cube.size, None, lambda _: dot_source(write_matrixviz, cube)
+
+    try:
+        import pandas as pd
+    except ImportError:
+        return
+    rows = n(1000000)
+    df = pd.DataFrame(dict(('c%d' % i, np.arange(rows) if i % 2 else np.random.rand(rows)) for i in range(20)))
+    df['name'] = 'x'
+    yield 'objviz DataFrame', rows, lambda: objgraph([df]), \
+        lambda graph: dot_source(write_objgraph, graph)
+
+
+def ms(t):
+    return '%10.2f' % (t*1000) if t is not None else '%10s' % '-'
+
+
+def ratio(new, old):
+    if new is None or not old:
+        return '%8s' % '-'
+    return '%7.2fx' % (float(new) / old)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time lolviz graph build, DOT emission and layout")
+    parser.add_argument('filter', nargs='?', default='', help="only run benchmarks whose name contains this")
+    parser.add_argument('--quick', action='store_true', help="run small workloads")
+    parser.add_argument('--repeat', type=int, default=3, help="report the best of this many runs")
+    parser.add_argument('--no-layout', action='store_true', help="don't run dot")
+    parser.add_argument('--json', help="write results to this file")
+    parser.add_argument('--compare', help="show results relative to this earlier --json file")
+    args = parser.parse_args()
+
+    old = {}
+    if args.compare:
+        with open(args.compare) as f:
+            old = dict(((r['name'], r['size']), r) for r in json.load(f)) # some names repeat with other sizes
+
+    print('%-36s %10s %10s %10s %10s %12s' % ('benchmark', 'size', 'build ms', 'emit ms', 'layout ms', 'DOT bytes'))
+    results = []
+    for name, size, build, emit in benchmarks(0.1 if args.quick else 1.0):
+        if args.filter not in name:
+            continue
+        r = measure(name, size, build, emit, args.repeat, not args.no_layout)
+        results.append(r)
+        print('%-36s %10d %s %s %s %12d' % (name, size, ms(r['build']), ms(r['emit']), ms(r['layout']), r['dot_bytes']))
+        if (name, size) in old:
+            o = old[name, size]
+            print('%-36s %10s   %s   %s   %s %12s' % ('', 'vs old', ratio(r['build'], o['build']),
+                  ratio(r['emit'], o['emit']), ratio(r['layout'], o['layout']), ratio(r['dot_bytes'], o['dot_bytes'])))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
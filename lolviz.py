@@ -12,21 +12,145 @@ into my notes.
 """
 from __future__ import print_function
 import graphviz
-import inspect
+import copy
+import gc
+import json
 import types
-from collections import defaultdict
+from collections import defaultdict, deque, OrderedDict
+import hashlib
+from itertools import islice
+import errno
+import os
+import re
+import struct
 import sys
+import threading
+from contextlib import contextmanager
+from timeit import default_timer as timer
+try:
+    from collections.abc import Sequence
+except ImportError: # python 2
+    from collections import Sequence
+try:
+    from html.entities import name2codepoint as _name2codepoint
+except ImportError: # python 2
+    from htmlentitydefs import name2codepoint as _name2codepoint
+try:
+    unichr
+except NameError: # python 3
+    unichr = chr
+try:
+    import contextvars
+    _prefs_var = contextvars.ContextVar('lolviz_prefs', default=None)
+except ImportError: # python < 3.7: settings() are per thread
+    _prefs_var = None
+    _prefs_local = threading.local()
 
 YELLOW = "#fefecd" # "#fbfbd0" # "#FBFEB0"
 BLUE = "#D9E6F5"
 GREEN = "#cfe2d4"
 
-class Prefs: pass
-prefs = Prefs()
+class Prefs:
+    """
+    A set of display preferences. default_prefs holds the global ones;
+    settings() makes copies in effect for one thread or asyncio task.
+    """
+    def __setattr__(self, name, value):
+        self.__dict__[name] = value
+        self.__dict__.pop('_key', None)
+
+    def copy(self):
+        p = Prefs()
+        p.__dict__.update(self.__dict__)
+        return p
+
+    def key(self):
+        """All the values, to key caches of things drawn with them"""
+        key = self.__dict__.get('_key')
+        if key is None:
+            key = tuple(sorted(item for item in self.__dict__.items() if item[0] != '_key'))
+            self.__dict__['_key'] = key
+        return key
+
+
+class CurrentPrefs:
+    """
+    The module's prefs: reading or setting an attribute goes to the
+    Prefs in effect, which is default_prefs outside any settings() block.
+    """
+    def __getattr__(self, name):
+        return getattr(current_prefs(), name)
+
+    def __setattr__(self, name, value):
+        setattr(current_prefs(), name, value)
+
+
+def current_prefs():
+    """Return the Prefs in effect for this thread or asyncio task"""
+    if _prefs_var is not None:
+        p = _prefs_var.get()
+    else:
+        p = getattr(_prefs_local, 'prefs', None)
+    return default_prefs if p is None else p
+
+
+@contextmanager
+def settings(base=None, **overrides):
+    """
+    Within the with block, prefs is a copy of base (default: the prefs
+    in effect) with overrides applied, for this thread or asyncio task
+    only, so threads can render with different limits at once:
+
+        with settings(max_list_elems=4, max_str_len=8):
+            g = objviz(data)
+
+    Yields the copy.
+    """
+    p = (base or current_prefs()).copy()
+    for name, value in overrides.items():
+        if name not in p.__dict__:
+            raise TypeError("settings() got an unknown pref %r" % name)
+        setattr(p, name, value)
+    if _prefs_var is not None:
+        token = _prefs_var.set(p)
+        try:
+            yield p
+        finally:
+            _prefs_var.reset(token)
+    else:
+        old = getattr(_prefs_local, 'prefs', None)
+        _prefs_local.prefs = p
+        try:
+            yield p
+        finally:
+            _prefs_local.prefs = old
+
+
+def with_current_prefs(f):
+    """
+    Return a function that calls f under the prefs in effect now, for
+    handing work to another thread, which would otherwise get the defaults.
+    """
+    p = current_prefs()
+    def call(*args, **kwargs):
+        with settings(p):
+            return f(*args, **kwargs)
+    return call
+
+
+default_prefs = Prefs()
+prefs = CurrentPrefs()
 prefs.max_str_len = 20         # how many chars before we abbreviate with ...?
 prefs.max_horiz_array_len = 40 # how many chars before it's too wide and we go vertical?
 prefs.max_list_elems = 10      # how many elements max to display in list (unused so far)
+prefs.max_dict_elems = 20      # how many entries of a dict or object's fields to display
+prefs.max_strviz_len = 64      # how many chars or bytes strviz() shows before cutting out the middle
 prefs.float_precision = 5      # how many decimal places to show for floats
+prefs.max_ndarray_slices = 6   # how many 2-D slices of an N-d array to show
+prefs.stats_hook = None        # called with the RenderStats of each visualization and layout
+prefs.inline_svg = True        # draw SVG for strviz, listviz, lolviz, matrixviz without dot?
+prefs.show_sizes = False       # label objviz/callsviz nodes with their size and retained size?
+prefs.size_heatmap = False     # with show_sizes, color node borders by retained size?
 
 class WrapAssoc:
     def __init__(self,assoc):
@@ -40,18 +164,933 @@ class Ellipsis:
         return '...'
 
 
-def strviz(astring):
-    s = """
+class FrozenAtom:
+    """A value copied by snapshot() that displays as the original's str() and repr()"""
+    def __init__(self, s, r):
+        self.s = s
+        self.r = r
+    def __str__(self):
+        return self.s
+    def __repr__(self):
+        return self.r
+
+
+class ListSample:
+    """
+    The elements of a possibly huge sequence or iterable that will
+    actually be displayed: all N of them if N <= maxelems, else the
+    first maxelems-1 and the last. Sequences are indexed so only those
+    elements are touched; other iterables are consumed without holding
+    more than maxelems of them. indexes holds each value's position.
+    """
+    def __init__(self, elems, maxelems=None):
+        if maxelems is None:
+            maxelems = prefs.max_list_elems
+        if isinstance(elems, Sequence):
+            N = len(elems)
+            if N > maxelems:
+                values = [elems[i] for i in range(maxelems-1)] + [elems[N-1]]
+            else:
+                values = list(elems)
+        else:
+            it = iter(elems)
+            values = list(islice(it, maxelems))
+            N = len(values)
+            rest = deque(enumerate(it, 1), maxlen=1) # count and keep just the last
+            if rest:
+                nrest, last = rest[0]
+                N += nrest
+                values = values[:maxelems-1] + [last]
+        if N > len(values):
+            indexes = list(range(len(values)-1)) + [N-1]
+        else:
+            indexes = list(range(N))
+        self.N = N
+        self.indexes = indexes
+        self.values = values
+
+    def __len__(self):
+        return self.N
+
+    def oversize(self):
+        return self.N > len(self.values)
+
+
+def dict_sample(d, maxelems=None):
+    """
+    Return the entries of dict d to display as a list of (position, key,
+    value): all of them if there are at most maxelems, else the first
+    and last few. Only those entries are touched, except on Pythons
+    before 3.8 where dict views can't be walked backwards to get the tail.
+    """
+    if maxelems is None:
+        maxelems = prefs.max_dict_elems
+    N = len(d)
+    if N <= maxelems:
+        return [(i, k, v) for i, (k, v) in enumerate(d.items())]
+    ntail = maxelems // 2
+    head = [(i, k, v) for i, (k, v) in enumerate(islice(d.items(), maxelems - ntail))]
+    try:
+        tail = list(islice(reversed(d.items()), ntail))[::-1]
+    except TypeError: # no reversed() for dict views
+        tail = list(deque(d.items(), maxlen=ntail))
+    return head + [(N - ntail + i, k, v) for i, (k, v) in enumerate(tail)]
+
+
+def list_sample(elems):
+    """Return elems as a ListSample, sampling it if it isn't already one"""
+    if isinstance(elems, ListSample):
+        return elems
+    return ListSample(elems)
+
+
+class DotWriter:
+    """
+    Sink for DOT text. Fragments are buffered in a list and joined once
+    by getvalue(), or passed straight through to a file-like object such
+    as an open file or the stdin of a graphviz process (see dot_pipe()),
+    in which case memory stays proportional to one node's markup.
+    """
+    def __init__(self, out=None):
+        self.out = out
+        self.parts = []
+        self.nchars = 0
+        self.stats = RenderStats()
+
+    def write(self, s):
+        self.nchars += len(s)
+        if self.out is None:
+            self.parts.append(s)
+        else:
+            self.out.write(s)
+
+    def getvalue(self):
+        return ''.join(self.parts)
+
+
+class RenderStats:
+    """
+    Where the work went in making one visualization: wall-clock seconds
+    per phase in the order they ran (e.g., graph, subgraphs, nodes,
+    edges, emit), objects visited, edges emitted, the size of the DOT in
+    bytes and, once laid out, the layout seconds (0 if it came from
+    render_cache, in which case cached is True). Results of the
+    visualization functions carry theirs as .stats, and prefs.stats_hook,
+    if set, is called with each one as it is made and again after layout.
+    """
+    def __init__(self):
+        self.phases = OrderedDict()
+        self.nodes = 0
+        self.edges = 0
+        self.dot_bytes = 0
+        self.layout = None
+        self.cached = False
+        self.last = timer()
+
+    def lap(self, phase):
+        """Charge the time since the previous lap to phase"""
+        now = timer()
+        self.phases[phase] = self.phases.get(phase, 0.0) + now - self.last
+        self.last = now
+
+    def total(self):
+        return sum(self.phases.values()) + (self.layout or 0.0)
+
+    def __repr__(self):
+        phases = ''.join('%s=%.1fms, ' % (phase, t*1000) for phase, t in self.phases.items())
+        layout = '%.1fms' % (self.layout*1000) if self.layout is not None else None
+        return 'RenderStats(%snodes=%d, edges=%d, dot_bytes=%d, layout=%s)' % \
+               (phases, self.nodes, self.edges, self.dot_bytes, layout)
+
+
+def report_stats(stats):
+    if prefs.stats_hook is not None:
+        prefs.stats_hook(stats)
+
+
+def linear_source(emit, *args):
+    """cached_source() for the fixed layouts linear_svg() can draw without dot"""
+    g = cached_source(emit, *args)
+    g.inline_layout = True
+    return g
+
+
+def cached_source(emit, *args, **kwargs):
+    """
+    Return a CachedSource for the DOT written by emit(w, *args, **kwargs)
+    with the RenderStats of making it as .stats.
+    """
+    w = DotWriter()
+    emit(w, *args, **kwargs)
+    source = w.getvalue()
+    w.stats.lap('emit')
+    w.stats.dot_bytes = len(source.encode('utf-8'))
+    g = CachedSource(source)
+    g.stats = w.stats
+    report_stats(w.stats)
+    return g
+
+
+def dot_source(emit, *args, **kwargs):
+    """Return the DOT text written by emit(w, *args, **kwargs) as one string"""
+    w = DotWriter()
+    emit(w, *args, **kwargs)
+    return w.getvalue()
+
+
+def dot_pipe(emit, format='svg', engine='dot', filename=None):
+    """
+    Launch a graphviz layout engine and stream the DOT written by
+    emit(w) straight into its stdin without ever holding the whole
+    source in memory. Return the rendered output as bytes, or write
+    it to filename and return None. E.g.,
+
+        svg = dot_pipe(lambda w: write_objviz(w, huge_graph))
+    """
+    import codecs
+    import subprocess
+    import tempfile
+    cmd = [engine, '-T%s' % format]
+    if filename is not None:
+        cmd.append('-o%s' % filename)
+    out = tempfile.TemporaryFile()
+    err = tempfile.TemporaryFile()
+    try:
+        proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=out, stderr=err)
+        stdin = codecs.getwriter('utf-8')(proc.stdin)
+        w = DotWriter(stdin)
+        try:
+            emit(w)
+            w.stats.lap('emit')
+            stdin.close()
+        except BaseException as e:
+            if getattr(e, 'errno', None) != errno.EPIPE: # emit failed, not the pipe
+                proc.kill()
+                proc.wait()
+                raise
+            try: # engine quit early; its stderr says why
+                proc.stdin.close()
+            except IOError:
+                pass
+        if proc.wait() != 0:
+            err.seek(0)
+            raise subprocess.CalledProcessError(proc.returncode, cmd, err.read())
+        w.stats.layout = timer() - w.stats.last
+        w.stats.dot_bytes = w.nchars # streamed, so count chars
+        report_stats(w.stats)
+        if filename is None:
+            out.seek(0)
+            return out.read()
+    finally:
+        out.close()
+        err.close()
+
+
+class LRUCache:
+    """A thread-safe mapping that holds at most maxsize of the most recently used entries"""
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.data)
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.data:
+                return default
+            value = self.data.pop(key) # reinsert as most recent
+            self.data[key] = value
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.data.pop(key, None)
+            if self.maxsize <= 0:
+                return
+            self.data[key] = value
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+
+class RenderCache:
+    """
+    Rendered graphviz output keyed by a hash of the DOT source, layout
+    engine, and output format so identical sources are laid out once.
+    Entries live in an in-memory LRU of maxsize renderings and, if
+    directory is set, in files there named by the key that are evicted
+    oldest first once they total more than max_disk_bytes. Other files
+    in directory are never touched.
+    """
+    def __init__(self, maxsize=64, directory=None, max_disk_bytes=256*1024*1024):
+        self.memory = LRUCache(maxsize)
+        self.directory = directory
+        self.max_disk_bytes = max_disk_bytes
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, source, engine, format, *options):
+        """
+        Node names hold id()s, which differ between runs and between
+        copies of the same structure, so they are numbered by first
+        appearance before hashing. The same drawing then has the same
+        key in every process.
+        """
+        h = hashlib.sha1(repr((engine, format) + options).encode('utf-8'))
+        h.update(b'\0')
+        h.update(canonical_dot(source).encode('utf-8'))
+        return h.hexdigest()
+
+    def get(self, key):
+        data = self.memory.get(key)
+        if data is None and self.directory is not None:
+            path = os.path.join(self.directory, key)
+            try:
+                with open(path, 'rb') as f:
+                    data = f.read()
+                os.utime(path, None) # mark as recently used
+                self.memory.put(key, data)
+            except (IOError, OSError):
+                data = None
+        if data is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return data
+
+    def put(self, key, data):
+        self.memory.put(key, data)
+        if self.directory is None:
+            return
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        path = os.path.join(self.directory, key)
+        tmp = '%s.%d.%d.tmp' % (path, os.getpid(), threading.current_thread().ident)
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        _replace(tmp, path)
+        self.evict()
+
+    def entries(self):
+        """The names of the cache's files in directory; other files there are left alone"""
+        return [name for name in os.listdir(self.directory) if _cache_file.match(name)]
+
+    def evict(self):
+        """Remove the least recently used files until the directory fits in max_disk_bytes"""
+        files = []
+        total = 0
+        for name in self.entries():
+            path = os.path.join(self.directory, name)
+            try:
+                st = os.stat(path)
+            except OSError: # removed by another process
+                continue
+            files.append((st.st_mtime, st.st_size, path))
+            total += st.st_size
+        files.sort()
+        for _, size, path in files:
+            if total <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+    def clear(self):
+        self.memory.clear()
+        if self.directory is not None and os.path.isdir(self.directory):
+            for name in self.entries():
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except OSError: # removed by another process
+                    pass
+
+
+def canonical_dot(source):
+    """Return source with the ids in nodeN and elidedN names renumbered 1, 2, ... by first appearance"""
+    numbers = {}
+    def renumber(m):
+        n = numbers.setdefault(m.group(3), len(numbers)+1)
+        return '%s%s%d' % (m.group(1), m.group(2), n)
+    return _dot_node_name.sub(renumber, source)
+
+
+_dot_node_name = re.compile(r'(^[ \t]*|->[ \t]*)(node|elided)(\d+)', re.M) # where a statement names a node
+_cache_file = re.compile(r'[0-9a-f]{40}$') # a RenderCache key
+_replace = getattr(os, 'replace', os.rename) # python 2: rename replaces, except on Windows
+
+
+render_cache = RenderCache()
+fragment_cache = LRUCache(1024) # HTML tables of atom lists and sets, see cached_fragment()
+
+
+class CachedSource(graphviz.Source):
+    """
+    A graphviz.Source whose pipe() and render() output, and so Jupyter
+    display, comes from render_cache when the same DOT has already been
+    laid out with the same engine and format.
+    """
+    stats = None # RenderStats
+    inline_layout = False # can linear_svg() draw it?
+
+    def inline_svg(self, format=None, engine=None, args=(), kwargs=None):
+        """
+        Return SVG bytes drawn by linear_svg() if this graph has a fixed
+        layout, prefs.inline_svg is on and a plain dot SVG is asked for;
+        otherwise return None.
+        """
+        if not (self.inline_layout and prefs.inline_svg) or args or set(kwargs or ()) - {'engine'}:
+            return None
+        if (format or self.format) != 'svg' or (engine or self.engine) != 'dot':
+            return None
+        return linear_svg(self.source).encode('utf-8')
+
+    def cache_key(self, format=None, engine=None, args=(), kwargs=None):
+        """The render_cache key of this source laid out by engine into format, with pipe() options"""
+        options = sorted((k, v) for k, v in (kwargs or {}).items() if k != 'engine')
+        return render_cache.key(self.source, engine or self.engine, format or self.format, tuple(args), options)
+
+    def pipe(self, format=None, *args, **kwargs):
+        encoding = kwargs.pop('encoding', None)
+        engine = kwargs.get('engine') or self.engine
+        if self.stats is None:
+            self.stats = RenderStats()
+        start = timer()
+        data = self.inline_svg(format, engine, args, kwargs)
+        if data is not None:
+            self.stats.layout = timer() - start
+            self.stats.cached = False
+            report_stats(self.stats)
+            return data.decode(encoding) if encoding is not None else data
+        key = self.cache_key(format, engine, args, kwargs)
+        data = render_cache.get(key)
+        if data is None:
+            start = timer()
+            data = graphviz.Source.pipe(self, format, *args, **kwargs)
+            self.stats.layout = timer() - start
+            self.stats.cached = False
+            render_cache.put(key, data)
+        else:
+            self.stats.layout = 0.0
+            self.stats.cached = True
+        report_stats(self.stats)
+        if encoding is not None:
+            return data.decode(encoding)
+        return data
+
+    def render(self, filename=None, directory=None, view=False, cleanup=False, format=None, *args, **kwargs):
+        if view or args or kwargs: # let graphviz handle viewers, renderers, etc...
+            return graphviz.Source.render(self, filename, directory, view, cleanup, format, *args, **kwargs)
+        format = format or self.format
+        filepath = self.save(filename, directory)
+        data = self.pipe(format)
+        outfile = '%s.%s' % (filepath, format)
+        with open(outfile, 'wb') as f:
+            f.write(data)
+        if cleanup:
+            os.remove(filepath)
+        return outfile
+
+
+def render_batch(items, directory='.', format='svg', prefix='lolviz', workers=None, progress=None):
+    """
+    Lay out many lolviz results concurrently and write them to files.
+    Each item is a graphviz Source, a DOT string, or a (source, filename)
+    pair; items without a filename are written to directory as, e.g.,
+    lolviz-0007.svg numbered by position so names are deterministic.
+    Missing directories are created.
+    At most workers dot processes (default: one per CPU) run at once.
+    If given, progress(done, total, filename, error) is called as each
+    item finishes. Failures don't stop the batch; return a list of
+    (filename, error) in item order where error is None on success.
+    """
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+    import multiprocessing
+
+    jobs = []
+    for i, item in enumerate(items):
+        if isinstance(item, tuple):
+            source, filename = item
+        else:
+            source, filename = item, None
+        if filename is None:
+            filename = os.path.join(directory, '%s-%04d.%s' % (prefix, i, format))
+        if not isinstance(source, CachedSource):
+            if isinstance(source, graphviz.Source):
+                source = CachedSource(source.source, engine=source.engine)
+            else:
+                source = CachedSource(source)
+        jobs.append((source, filename))
+    for parent in set(os.path.dirname(filename) for _, filename in jobs):
+        if parent and not os.path.isdir(parent):
+            os.makedirs(parent)
+
+    def render(source, filename):
+        data = source.pipe(format)
+        with open(filename, 'wb') as f:
+            f.write(data)
+
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    results = [None] * len(jobs)
+    with ThreadPoolExecutor(max_workers=workers) as pool: # threads just wait on dot processes
+        futures = {}
+        for i, (source, filename) in enumerate(jobs):
+            futures[pool.submit(with_current_prefs(render), source, filename)] = i
+        done = 0
+        for future in as_completed(futures):
+            i = futures[future]
+            filename = jobs[i][1]
+            error = future.exception()
+            results[i] = (filename, error)
+            done += 1
+            if progress is not None:
+                progress(done, len(jobs), filename, error)
+    return results
+
+
+# In-process SVG for the fixed layouts of strviz(), listviz(), lolviz() and
+# matrixviz(). Those graphs are a few HTML-label tables and, for lolviz(),
+# one column of arrows, so we can size and place them ourselves instead of
+# starting dot. Text is measured with Helvetica's widths, as graphviz does
+# when it has no font files.
+
+# Helvetica advance widths per 1000 units of font size for ' ' through '~'
+_helvetica_widths = (
+    278, 278, 355, 556, 556, 889, 667, 191, 333, 333, 389, 584, 278, 333, 278, 278,
+    556, 556, 556, 556, 556, 556, 556, 556, 556, 556, 278, 278, 584, 584, 584, 556,
+    1015, 667, 667, 722, 722, 667, 611, 778, 722, 278, 500, 667, 556, 833, 722, 778,
+    667, 778, 722, 667, 611, 722, 667, 944, 667, 667, 611, 278, 278, 278, 469, 556,
+    333, 556, 556, 500, 556, 556, 278, 556, 556, 222, 222, 500, 222, 833, 556, 556,
+    556, 556, 333, 500, 278, 556, 500, 722, 500, 500, 500, 334, 260, 334, 584)
+
+
+def text_width(s, face, size):
+    face = face.lower()
+    if 'monaco' in face or 'courier' in face or 'mono' in face:
+        return len(s) * 0.6 * size
+    w = 0
+    for c in s:
+        i = ord(c) - 32
+        w += _helvetica_widths[i] if 0 <= i < len(_helvetica_widths) else 556
+    if 'times' in face:
+        w *= 0.9
+    return w * size / 1000.0
+
+
+class HtmlTable:
+    def __init__(self, attrs):
+        self.attrs = attrs
+        self.rows = []
+
+
+class HtmlCell:
+    """A <td>, or the whole label, holding text runs or a nested table"""
+    def __init__(self, attrs):
+        self.attrs = attrs
+        self.runs = [] # (text, face, color, size, italic)
+        self.table = None
+        self.size = None
+
+
+def parse_html_label(html, face, color, size):
+    """
+    Parse a graphviz HTML-like label as lolviz writes them into a root
+    HtmlCell holding text runs or HtmlTables. face, color and size are
+    the node's font.
+    """
+    root = HtmlCell({})
+    cells = [root]
+    tables = []
+    fonts = [(face, color, size)]
+    italic = 0
+    for m in _html_token.finditer(html):
+        end, tag, attrtext, data = m.groups()
+        if data is not None:
+            cell = cells[-1]
+            if cell.table is not None or not data.strip() and (cell is root or '\n' in data):
+                continue # formatting between tags
+            face, color, size = fonts[-1]
+            cell.runs.append((_html_entity.sub(html_entity, data), face, color, size, italic > 0))
+            continue
+        tag = tag.lower()
+        if end:
+            if tag == 'table':
+                tables.pop()
+            elif tag == 'td':
+                cells.pop()
+            elif tag == 'font':
+                fonts.pop()
+            elif tag == 'i':
+                italic -= 1
+            continue
+        attrs = dict((k.lower(), v) for k, v in _html_attr.findall(attrtext))
+        if tag == 'table':
+            table = HtmlTable(attrs)
+            cells[-1].table = table
+            tables.append(table)
+        elif tag == 'tr':
+            tables[-1].rows.append([])
+        elif tag == 'td':
+            cell = HtmlCell(attrs)
+            tables[-1].rows[-1].append(cell)
+            cells.append(cell)
+        elif tag == 'font':
+            face, color, size = fonts[-1]
+            fonts.append((attrs.get('face', face), attrs.get('color', color),
+                          float(attrs.get('point-size', size))))
+        elif tag == 'i':
+            italic += 1
+    return root
+
+
+_html_token = re.compile(r'<(/?)([a-zA-Z]+)([^>]*)>|([^<]+|<)') # a tag or text (maybe a stray <)
+_html_attr = re.compile(r'([\w-]+)\s*=\s*"([^"]*)"')
+_html_entity = re.compile(r'&(#?\w+);')
+
+
+def html_entity(m):
+    name = m.group(1)
+    if name[:2] in ('#x', '#X'):
+        return unichr(int(name[2:], 16))
+    if name[0] == '#':
+        return unichr(int(name[1:]))
+    if name in _name2codepoint:
+        return unichr(_name2codepoint[name])
+    return m.group(0)
+
+
+def html_size(cell):
+    """Return the (width, height) of cell's content, laying out any nested table"""
+    if cell.size is None:
+        if cell.table is not None:
+            cell.size = layout_table(cell.table)
+        elif cell.runs:
+            w = sum(text_width(text, face, size) for text, face, color, size, italic in cell.runs)
+            h = max(size for text, face, color, size, italic in cell.runs) * 1.2
+            cell.size = w, h
+        else:
+            cell.size = 0, 0
+    return cell.size
+
+
+def layout_table(table):
+    """
+    Size table's rows and columns as graphviz does and record each
+    cell's (x, y, w, h) relative to the table. Return the table's size.
+    """
+    attrs = table.attrs
+    border = int(attrs.get('border', 1))
+    cellborder = int(attrs.get('cellborder', border))
+    spacing = int(attrs.get('cellspacing', 2))
+    padding = int(attrs.get('cellpadding', 2))
+
+    grid = [] # (cell, row, col, colspan, w, h)
+    for r, row in enumerate(table.rows):
+        col = 0
+        for cell in row:
+            span = int(cell.attrs.get('colspan', 1))
+            cell.border = int(cell.attrs.get('border', cellborder))
+            pad = int(cell.attrs.get('cellpadding', padding))
+            w, h = html_size(cell)
+            w += 2 * (pad + cell.border)
+            h = max(h + 2 * (pad + cell.border), float(cell.attrs.get('height', 0)))
+            grid.append((cell, r, col, span, w, h))
+            col += span
+    ncols = max([col + span for cell, r, col, span, w, h in grid] or [0])
+    widths = [0] * ncols
+    heights = [0] * len(table.rows)
+    for cell, r, col, span, w, h in grid:
+        heights[r] = max(heights[r], h)
+        if span == 1:
+            widths[col] = max(widths[col], w)
+    for cell, r, col, span, w, h in grid:
+        extra = w - sum(widths[col:col+span]) - (span - 1) * spacing
+        if span > 1 and extra > 0:
+            for c in range(col, col+span):
+                widths[c] += extra / span
+
+    for cell, r, col, span, w, h in grid:
+        cell.x = border + spacing + sum(widths[:col]) + col * spacing
+        cell.y = border + spacing + sum(heights[:r]) + r * spacing
+        cell.w = sum(widths[col:col+span]) + (span - 1) * spacing
+        cell.h = heights[r]
+    table.border = border
+    table.w = sum(widths) + (ncols + 1) * spacing + 2 * border
+    table.h = sum(heights) + (len(heights) + 1) * spacing + 2 * border
+    return table.w, table.h
+
+
+def font_attrs(face, size, italic):
+    face = face.lower()
+    if 'times' in face:
+        family = 'Times,serif'
+        italic = italic or 'italic' in face
+    elif 'monaco' in face or 'courier' in face:
+        family = 'Monaco,Courier,monospace'
+    else:
+        family = 'Helvetica,sans-Serif'
+    style = ' font-style="italic"' if italic else ''
+    return 'font-family="%s" font-size="%.2f"%s' % (family, size, style)
+
+
+def xml_escape(s):
+    return s.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;').replace('"', '&quot;')
+
+
+def draw_content(out, cell, x, y, w, h, ports, pencolor):
+    """Draw cell's content inside the box (x, y, w, h) by its align and valign"""
+    align = cell.attrs.get('align', 'center').lower()
+    valign = cell.attrs.get('valign', 'middle').lower()
+    cw, ch = html_size(cell)
+    if align == 'left':
+        cx = x
+    elif align == 'right':
+        cx = x + w - cw
+    else:
+        cx = x + (w - cw) / 2.0
+    if valign == 'top':
+        cy = y
+    elif valign == 'bottom':
+        cy = y + h - ch
+    else:
+        cy = y + (h - ch) / 2.0
+    if cell.table is not None:
+        draw_table(out, cell.table, cx, cy, ports, pencolor)
+        return
+    baseline = cy + ch / 2.0 + 0.3 * max([size for text, face, color, size, italic in cell.runs] or [0])
+    for text, face, color, size, italic in cell.runs:
+        out.append('<text xml:space="preserve" x="%.2f" y="%.2f" %s fill="%s">%s</text>\n' %
+                   (cx, baseline, font_attrs(face, size, italic), color, xml_escape(text)))
+        cx += text_width(text, face, size)
+
+
+def draw_table(out, table, x, y, ports, pencolor):
+    """Draw a table laid out by layout_table() with its top left at (x, y)"""
+    if 'bgcolor' in table.attrs:
+        out.append('<rect x="%.2f" y="%.2f" width="%.2f" height="%.2f" fill="%s" stroke="none"/>\n' %
+                   (x, y, table.w, table.h, table.attrs['bgcolor']))
+    if table.border > 0:
+        b = table.border / 2.0
+        out.append('<rect x="%.2f" y="%.2f" width="%.2f" height="%.2f" fill="none" stroke="%s" stroke-width="%d"/>\n' %
+                   (x+b, y+b, table.w-2*b, table.h-2*b, pencolor, table.border))
+    for row in table.rows:
+        for cell in row:
+            cx, cy, w, h = x + cell.x, y + cell.y, cell.w, cell.h
+            if 'port' in cell.attrs:
+                ports[cell.attrs['port']] = (cx, cy, w, h)
+            if 'bgcolor' in cell.attrs:
+                out.append('<rect x="%.2f" y="%.2f" width="%.2f" height="%.2f" fill="%s" stroke="none"/>\n' %
+                           (cx, cy, w, h, cell.attrs['bgcolor']))
+            b = cell.border
+            if b > 0:
+                sides = cell.attrs.get('sides', 'ltrb').lower()
+                left, top, right, bottom = cx + b/2.0, cy + b/2.0, cx + w - b/2.0, cy + h - b/2.0
+                lines = {'l': (left, top, left, bottom), 't': (left, top, right, top),
+                         'r': (right, top, right, bottom), 'b': (left, bottom, right, bottom)}
+                for side in 'ltrb':
+                    if side in sides:
+                        out.append('<line x1="%.2f" y1="%.2f" x2="%.2f" y2="%.2f" stroke="%s" stroke-width="%d"/>\n' %
+                                   (lines[side] + (pencolor, b)))
+            pad = b + int(cell.attrs.get('cellpadding', table.attrs.get('cellpadding', 2)))
+            draw_content(out, cell, cx + pad, cy + pad, w - 2*pad, h - 2*pad, ports, pencolor)
+
+
+def dot_attrs(text):
+    """Parse a DOT attribute list such as 'shape="box", width=.1' into a dict (HTML labels excluded)"""
+    attrs = {}
+    for name, quoted, bare in re.findall(r'(\w+)\s*=\s*(?:"((?:[^"\\]|\\.)*)"|([^,\s<\]]+))', text):
+        attrs[name] = quoted if bare == '' else bare
+    return attrs
+
+
+class SvgNode:
+    def __init__(self, name, attrs, label):
+        self.name = name
+        self.attrs = attrs
+        self.label = label # HtmlCell
+        self.rank = 0
+
+
+def linear_svg(source):
+    """
+    Lay out and draw, as an SVG string, the DOT written by write_strviz(),
+    write_listviz(), write_lolviz() or write_matrixviz(). Nodes sit in
+    ranks along rankdir; a node whose incoming edge leaves from a port
+    lines up with that port when there's room.
+    """
+    graph = {}
+    for m in re.finditer(r'^\s*(nodesep|ranksep|rankdir)\s*=\s*"?([\w.]+)"?', source, re.M):
+        graph[m.group(1)] = m.group(2)
+    defaults = {}
+    m = re.search(r'^\s*node\s*\[(.*?)\];', source, re.M)
+    if m:
+        defaults = dot_attrs(m.group(1))
+
+    nodes = OrderedDict()
+    for m in re.finditer(r'^\s*(node\d+)\s*\[(.*?)label=<(.*?)>\];[ \t]*$', source, re.M | re.S):
+        name, attrtext, html = m.groups()
+        attrs = dict(defaults)
+        attrs.update(dot_attrs(attrtext))
+        label = parse_html_label(html, attrs.get('fontname', 'Times-Roman'), attrs.get('fontcolor', 'black'),
+                                 float(attrs.get('fontsize', 14)))
+        nodes[name] = SvgNode(name, attrs, label)
+    edges = []
+    for m in re.finditer(r'^\s*(node\d+)(?::(\w*))?\s*->\s*(node\d+)(?::\w+)?\s*\[(.*?)\]', source, re.M):
+        src, port, dst, attrtext = m.groups()
+        if src in nodes and dst in nodes:
+            edges.append((nodes[src], port, nodes[dst], dot_attrs(attrtext)))
+    # rank is the longest path from a source, found in one topological pass
+    targets = defaultdict(list)
+    incoming = {} # node name -> (src, port) of its first incoming edge
+    indegree = defaultdict(int)
+    for src, port, dst, attrs in edges:
+        targets[src.name].append(dst)
+        incoming.setdefault(dst.name, (src, port))
+        indegree[dst.name] += 1
+    ready = [node for node in nodes.values() if not indegree[node.name]]
+    while ready:
+        src = ready.pop()
+        for dst in targets[src.name]:
+            dst.rank = max(dst.rank, src.rank + 1)
+            indegree[dst.name] -= 1
+            if not indegree[dst.name]:
+                ready.append(dst)
+
+    for node in nodes.values():
+        w, h = html_size(node.label)
+        margin = node.attrs.get('margin')
+        if margin is not None:
+            mx = float(margin.split(',')[0]) * 72
+            my = float(margin.split(',')[-1]) * 72
+        else:
+            mx, my = 8, 4
+        node.w = max(w + 2*mx, float(node.attrs.get('width', .75)) * 72)
+        node.h = max(h + 2*my, float(node.attrs.get('height', .5)) * 72)
+        node.out = [] # SVG for the node, drawn at 0,0 then moved with translate
+        node.ports = {}
+        draw_node(node.out, node, w, h)
+
+    lr = graph.get('rankdir', 'TB') == 'LR'
+    nodesep = float(graph.get('nodesep', .25)) * 72
+    ranksep = float(graph.get('ranksep', .5)) * 72
+    ranks = defaultdict(list)
+    for node in nodes.values():
+        ranks[node.rank].append(node)
+    main = 0.0 # position along rankdir of the current rank
+    for r in sorted(ranks):
+        rank = ranks[r]
+        depth = max((n.w if lr else n.h) for n in rank)
+        cross = 0.0 # position across rankdir of the next node in this rank
+        for node in rank:
+            size = node.h if lr else node.w
+            start = cross
+            if node.name in incoming:
+                src, port = incoming[node.name]
+                start = max(cross, port_center(src, port, lr) - size/2.0)
+            offset = (depth - (node.w if lr else node.h)) / 2.0
+            node.x, node.y = (main + offset, start) if lr else (start, main + offset)
+            cross = start + size + nodesep
+        main += depth + ranksep
+
+    pad = 4
+    top = min([node.y for node in nodes.values()] or [0])
+    left = min([node.x for node in nodes.values()] or [0])
+    for node in nodes.values():
+        node.x += pad - left
+        node.y += pad - top
+    width = max([node.x + node.w for node in nodes.values()] or [0]) + pad
+    height = max([node.y + node.h for node in nodes.values()] or [0]) + pad
+
+    out = ['<?xml version="1.0" encoding="UTF-8" standalone="no"?>\n',
+           '<svg width="%.0fpt" height="%.0fpt" viewBox="0.00 0.00 %.2f %.2f" '
+           'xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink">\n' %
+           (width, height, width, height),
+           '<g id="graph0" class="graph">\n']
+    for node in nodes.values():
+        out.append('<g id="%s" class="node" transform="translate(%.2f,%.2f)">\n' % (node.name, node.x, node.y))
+        out.extend(node.out)
+        out.append('</g>\n')
+    for src, port, dst, attrs in edges:
+        out.append(draw_edge(src, port, dst, attrs, lr))
+    out.append('</g>\n</svg>\n')
+    return ''.join(out)
+
+
+def draw_node(out, node, w, h):
+    attrs = node.attrs
+    shape = attrs.get('shape', 'box')
+    color = attrs.get('color', 'black')
+    if shape not in ('none', 'plaintext'):
+        fill = attrs.get('fillcolor', color) if 'filled' in attrs.get('style', '') else 'none'
+        out.append('<rect x="0" y="0" width="%.2f" height="%.2f" fill="%s" stroke="%s" stroke-width="%s"/>\n' %
+                   (node.w, node.h, fill, color, attrs.get('penwidth', 1)))
+    draw_content(out, node.label, (node.w - w) / 2.0, (node.h - h) / 2.0, w, h, node.ports, color)
+
+
+def port_center(node, port, lr):
+    """Where, across rankdir, an edge from node's port leaves it"""
+    if port in node.ports:
+        x, y, w, h = node.ports[port]
+        return node.y + y + h/2.0 if lr else node.x + x + w/2.0
+    return node.y + node.h/2.0 if lr else node.x + node.w/2.0
+
+
+def draw_edge(src, port, dst, attrs, lr):
+    """A curve from src's port (or side) to the middle of dst's near side, with an arrowhead"""
+    if port in src.ports:
+        x, y, w, h = src.ports[port]
+        sx, sy = (src.x + x + w, src.y + y + h/2.0) if lr else (src.x + x + w/2.0, src.y + y + h)
+    else:
+        sx, sy = (src.x + src.w, src.y + src.h/2.0) if lr else (src.x + src.w/2.0, src.y + src.h)
+    ex, ey = (dst.x, dst.y + dst.h/2.0) if lr else (dst.x + dst.w/2.0, dst.y)
+    length = 10 * float(attrs.get('arrowsize', 1))
+    half = length * 0.35
+    color = attrs.get('color', 'black')
+    if lr:
+        bx, by = ex - length, ey # base of the arrowhead
+        mid = (sx + bx) / 2.0
+        path = 'M%.2f,%.2f C%.2f,%.2f %.2f,%.2f %.2f,%.2f' % (sx, sy, mid, sy, mid, by, bx, by)
+        head = (ex, ey, bx, by - half, bx, by + half)
+    else:
+        bx, by = ex, ey - length
+        mid = (sy + by) / 2.0
+        path = 'M%.2f,%.2f C%.2f,%.2f %.2f,%.2f %.2f,%.2f' % (sx, sy, sx, mid, bx, mid, bx, by)
+        head = (ex, ey, bx - half, by, bx + half, by)
+    return ('<g class="edge">\n<path d="%s" fill="none" stroke="%s" stroke-width="%s"/>\n'
+            '<polygon points="%.2f,%.2f %.2f,%.2f %.2f,%.2f" fill="%s" stroke="%s" stroke-width="%s"/>\n</g>\n' %
+            ((path, color, attrs.get('penwidth', 1)) + head + (color, color, attrs.get('penwidth', 1))))
+
+
+def strviz(astring, start=None, stop=None, showhex=False, wrap=None):
+    """
+    Show a str, bytes, bytearray or memoryview as an array of chars or
+    bytes. Only astring[start:stop] is shown and, if that is longer than
+    prefs.max_strviz_len, only its head and tail. Buffers are sliced
+    through a memoryview, so displaying part of a huge one copies just
+    that part. If showhex, show byte values (or code points) in hex.
+    If wrap, break the cells into rows of that many.
+    """
+    return linear_source(write_strviz, astring, start, stop, showhex, wrap)
+
+
+def write_strviz(w, astring, start=None, stop=None, showhex=False, wrap=None):
+    w.write("""
     digraph G {
         nodesep=.05;
         rankdir=LR;
         node [shape=box, penwidth="0.5"];
-    """
+    """)
 
-    s += string_node(astring)
+    w.write(string_node(astring, start, stop, showhex, wrap))
 
-    s += '}\n'
-    return graphviz.Source(s)
+    w.write('}\n')
 
 
 def listviz(elems, showassoc=True):
@@ -59,23 +1098,28 @@ def listviz(elems, showassoc=True):
     Display a list of elements in a horizontal fashion.
     If showassoc, then 2-tuples (3,4) are shown as 3->4.
     """
-    s = """
+    return linear_source(write_listviz, elems, showassoc)
+
+
+def write_listviz(w, elems, showassoc=True):
+    w.write("""
     digraph G {
         nodesep=.05;
         node [penwidth="0.5", width=.1,height=.1];
-    """
+    """)
 
+    sample = ListSample(elems) # only wrap elements we'll display
     newelems = []
-    for e in elems:
+    for e in sample.values:
         if showassoc and type(e) == tuple and len(e) == 2:
             newelems.append(WrapAssoc(e))
         else:
             newelems.append(e)
+    sample.values = newelems
 
-    s += gr_list_node('node%d'%id(elems), newelems)
+    w.write(gr_list_node('node%d'%id(elems), sample))
 
-    s += "}\n"
-    return graphviz.Source(s)
+    w.write("}\n")
 
 
 def treeviz(root, leftfield='left', rightfield='right'):
@@ -88,38 +1132,42 @@ def treeviz(root, leftfield='left', rightfield='right'):
     if root is None:
         return
 
-    s = """
+    return cached_source(write_treeviz, root, leftfield, rightfield)
+
+
+def write_treeviz(w, root, leftfield='left', rightfield='right'):
+    graph = ObjGraph()
+    graph.add(root)
+    w.stats.nodes += len(graph.index)
+    w.stats.lap('graph')
+    write_treegraph(w, graph, leftfield, rightfield)
+
+
+def write_treegraph(w, graph, leftfield='left', rightfield='right'):
+    w.write("""
     digraph G {
         nodesep=.1;
         ranksep=.3;
         rankdir=TD;
         node [penwidth="0.5", shape=box, width=.1, height=.1];
 
-    """
-
-    reachable = closure(root)
+    """)
 
-    for p in reachable:
-        nodename = "node%d" % id(p)
-        fields = []
-        if hasattr(p,leftfield) or hasattr(p,rightfield):
-            for k, v in p.__dict__.items():
-                if k==leftfield or k==rightfield:
-                    continue
-                if isatom(v):
-                    fields.append((k, k, v))
-                else:
-                    fields.append((k, k, None))
-            s += '// %s TREE node with fields\n' % p.__class__.__name__
-            s += gr_vtree_node(p.__class__.__name__, nodename, fields, separator=None)
+    for gnode in graph.nodes:
+        p = gnode.obj
+        nodename = "node%d" % gnode.id
+        if gnode.kind == 'object' and (hasattr(p,leftfield) or hasattr(p,rightfield)):
+            fields = [f for f in gnode.fields if f[1]!=leftfield and f[1]!=rightfield]
+            w.write('// %s TREE node with fields\n' % gnode.name)
+            w.write(gr_vtree_node(gnode.name, nodename, fields, separator=None))
         else:
-            s += obj_node(p)
+            w.write(gr_obj_node(gnode))
+    w.stats.lap('nodes')
 
-    # s += obj_nodes(reachable)
-    s += obj_edges(reachable)
+    # write_obj_nodes(w, graph)
+    write_obj_edges(w, graph)
 
-    s += "}\n"
-    return graphviz.Source(s)
+    w.write("}\n")
 
 
 def lolviz(table, showassoc=True):
@@ -133,276 +1181,759 @@ def lolviz(table, showassoc=True):
 
     If showassoc, display 2-tuples (x,y) as x->y.
     """
+    return linear_source(write_lolviz, table, showassoc)
+
+
+def write_lolviz(w, table, showassoc=True):
     if not islol(table):
-        return listviz(table, showassoc)
+        return write_listviz(w, table, showassoc)
 
-    s = """
+    w.write("""
     digraph G {
         nodesep=.05;
         ranksep=.4;
         rankdir=LR;
         node [penwidth="0.5", shape=box, width=.1, height=.1];
 
-    """
+    """)
     sublists = table
 
     nodename = "node%d" % id(table)
-    s += gr_vlol_node(nodename, table) # add vlist
+    w.write(gr_vlol_node(nodename, table)) # add vlist
 
     for sublist in sublists:
         nodename = "node%d" % id(sublist)
-        s += gr_list_node(nodename, sublist)
+        w.write(gr_list_node(nodename, sublist))
 
     i = 0
     for sublist in sublists:
-        s += 'node%d:%s -> node%d:w [arrowtail=dot, penwidth="0.5", color="#444443", arrowsize=.4, weight=100]\n' % (id(table), str(i), id(sublist))
+        w.write('node%d:%s -> node%d:w [arrowtail=dot, penwidth="0.5", color="#444443", arrowsize=.4, weight=100]\n' % (id(table), str(i), id(sublist)))
         i += 1
+    w.stats.edges += len(sublists)
 
-    s += "}\n"
-    return graphviz.Source(s)
+    w.write("}\n")
 
 
 def ndarrayviz(data):
-    return None
+    """
+    Visualize an N-d numpy array, or an array-like with shape, dtype
+    and slicing such as np.memmap or an h5py dataset. Arrays with more
+    than 2 dimensions are shown as a stack of 2-D tables, one per index
+    of the leading axes. Only the displayed elements are read.
+    """
+    return linear_source(write_matrixviz, data)
 
 
-def callviz(frame=None, varnames=None):
+def callviz(frame=None, varnames=None, max_nodes=None, max_depth=None):
     """
     Visualize one call stack frame. If frame is None, viz
     caller of callviz()'s frame. Restrict to varnames if
     not None.
     """
     if frame is None:
-        stack = inspect.stack()
-        frame = stack[1][0]
+        frame = sys._getframe(1)
 
-    return callsviz([frame], varnames)
+    return callsviz([frame], varnames, max_nodes, max_depth)
 
 
-def callsviz(callstack=None, varnames=None):
-    s = """
+def callsviz(callstack=None, varnames=None, max_nodes=None, max_depth=None):
+    """
+    Visualize the call stack and everything reachable from it. As with
+    objviz(), max_nodes and max_depth bound how much of the heap is drawn.
+    """
+    # Get stack frame nodes so we can stack 'em up
+    if callstack is None:
+        callstack = caller_frames(sys._getframe(1))
+
+    return cached_source(write_callsviz, callstack, varnames, max_nodes, max_depth)
+
+
+def caller_frames(frame):
+    """
+    Return frame and its callers up to and including <module>. Follows
+    f_back rather than using inspect.stack(), which reads source lines
+    from disk for every frame.
+    """
+    callstack = []
+    while frame is not None:
+        callstack.append(frame)
+        if frame.f_code.co_name=='<module>':
+            break
+        frame = frame.f_back
+    return callstack
+
+
+def write_callsviz(w, callstack, varnames=None, max_nodes=None, max_depth=None):
+    """
+    Write callsviz() of callstack, innermost frame first. It must be
+    given: called from dot_pipe() or dot_source(), the frames above this
+    one are lolviz's and the emit function's, not the ones to show. Get
+    the caller's with caller_frames(sys._getframe()).
+    """
+    # find all reachable objects from call stack in one walk
+    callstack = list(reversed(callstack))
+    graph = ObjGraph(varnames, max_nodes, max_depth)
+    for f in callstack:
+        graph.add(f)
+    frames = [graph.index[id(f)] for f in callstack]
+    w.stats.nodes += len(graph.index)
+    w.stats.lap('graph')
+    write_stack_graph(w, graph, frames)
+
+
+def write_stack_graph(w, graph, frames):
+    """Draw graph with the GraphNodes of its stack frames (outermost first) side by side"""
+    w.write("""
     digraph G {
         nodesep=.1;
         ranksep=.1;
         rankdir=LR;
         node [penwidth="0.5", shape=box, width=.1, height=.1];
 
+    """)
+
+    # Draw all stack frame nodes together so we can use rank=same
+    w.write("\n{ rank=same;\n")
+    for gnode in frames:
+        w.write(gr_obj_node(gnode))
+
+    for i in range(len(frames)-1):
+        this = frames[i]
+        callee = frames[i+1]
+        w.write('node%d -> node%d [style=invis, weight=100]\n' % (this.id, callee.id))
+    w.write("}\n\n")
+    w.stats.lap('nodes')
+
+    write_obj_nodes(w, graph)
+    stubs = {}
+    write_obj_edges(w, graph, stubs=stubs)
+    write_obj_edges(w, frames, graph=graph, stubs=stubs)
+    w.write("}\n")
+
+
+def ignoresym(sym):
+    return sym[0].startswith('_') or\
+           callable(sym[1]) or\
+           isinstance(sym[1], types.ModuleType) or\
+           globals().get(sym[0], ignoresym) is sym[1] # prefs, caches from "from lolviz import *"
+
+
+class TraceStep:
+    """
+    One recorded state of a traced run: where it was taken plus how the
+    graph changed since the previous step. changed maps id -> frozen
+    GraphNode for nodes that are new or differ, removed lists the ids
+    that went away, and order/frames list the ids of the non-frame nodes
+    and the stack frames (outermost first); these are shared with the
+    previous step when unchanged.
+    """
+    def __init__(self, event, funcname, lineno, changed, removed, order, frames, truncated):
+        self.event = event
+        self.funcname = funcname
+        self.lineno = lineno
+        self.changed = changed
+        self.removed = removed
+        self.order = order
+        self.frames = frames
+        self.truncated = truncated
+
+
+class Tracer:
+    """
+    Record callsviz() snapshots while a function runs, using
+    sys.settrace(), to animate an algorithm:
+
+        t = Tracer(varnames=['a', 'lo', 'hi'], lines=[12, 15])
+        t.run(quicksort, data)
+        t.render('build/qs')  # one SVG per step
+        t.gif('qs.gif')       # needs Pillow
+
+    By default every line executed in the file that defines the traced
+    function is a step, plus each return. Restrict that with lines (line
+    numbers), functions (functions or their names) and events (any of
+    'call', 'line', 'return'); stop recording after max_steps. A with
+    block traces the code inside it instead of a function call.
+
+    Each step stores only the nodes that changed since the previous one,
+    frozen so that later mutation doesn't alter the recording, so memory
+    grows with the amount of change rather than the number of steps.
     """
+    def __init__(self, varnames=None, lines=None, functions=None, events=('line', 'return'),
+                 max_steps=None, max_nodes=None, max_depth=None):
+        self.varnames = varnames
+        self.lines = None if lines is None else set(lines)
+        self.functions = None if functions is None else \
+            set(getattr(f, '__code__', f) for f in functions) # code objects or names
+        self.events = events
+        self.max_steps = max_steps
+        self.max_nodes = max_nodes
+        self.max_depth = max_depth
+        self.steps = []
+        self._sigs = {}    # id -> signature of the node as of the last step
+        self._order = ()
+        self._frames = ()
+        self._caller = None
+        self._filename = None
+
+    def __len__(self):
+        return len(self.steps)
+
+    def run(self, func, *args, **kwargs):
+        """Call func(*args, **kwargs) while recording; return its result"""
+        code = getattr(func, '__code__', None)
+        self._start(sys._getframe(), code.co_filename if code is not None else None)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            sys.settrace(self._previous)
+
+    def __enter__(self):
+        frame = sys._getframe(1)
+        self._start(frame.f_back, frame.f_code.co_filename)
+        frame.f_trace = self._trace_line
+        return self
+
+    def __exit__(self, *exc):
+        sys.settrace(self._previous)
+        sys._getframe(1).f_trace = None
+        return False
 
-    # Get stack frame nodes so we can stack 'em up
-    if callstack is None:
-        stack = inspect.stack()
+    def _start(self, caller, filename):
+        self._caller = caller
+        self._filename = filename
+        self._previous = sys.gettrace()
+        sys.settrace(self._trace_call)
+
+    def _wants(self, code):
+        if self.functions is not None:
+            return code in self.functions or code.co_name in self.functions
+        return code.co_filename == self._filename
+
+    def _full(self):
+        return self.max_steps is not None and len(self.steps) >= self.max_steps
+
+    def _trace_call(self, frame, event, arg):
+        if not self._wants(frame.f_code) or self._full():
+            return None
+        if event in self.events:
+            self._record(frame, event)
+        return self._trace_line
+
+    def _trace_line(self, frame, event, arg):
+        if self._full():
+            return None
+        if event in self.events and (self.lines is None or frame.f_lineno in self.lines):
+            self._record(frame, event)
+        return self._trace_line
+
+    def _record(self, frame, event):
+        """Add a step showing the stack from frame up to where tracing started"""
         callstack = []
-        for i,st in enumerate(stack[1:]):
-            frame = st[0]
-            name = st[3]
+        while frame is not None and frame is not self._caller:
             callstack.append(frame)
-            if name=='<module>':
-                break
+            frame = frame.f_back
+        callstack.reverse()
+        graph = ObjGraph(self.varnames, self.max_nodes, self.max_depth, caller=self._caller)
+        for f in callstack:
+            graph.add(f)
+
+        changed = {}
+        sigs = self._sigs
+        for i, gnode in graph.index.items():
+            dot = live_dot(gnode)
+            sig = (gnode.type, gnode.kind, gnode.name, fields_sig(gnode.fields), gnode.edges, gnode.highlight, dot, gnode.more)
+            if sigs.get(i) != sig:
+                sigs[i] = sig
+                changed[i] = frozen_node(gnode, dot)
+        removed = [i for i in sigs if i not in graph.index]
+        for i in removed:
+            del sigs[i]
+
+        order = tuple(gnode.id for gnode in graph.nodes)
+        if order != self._order:
+            self._order = order
+        frames = tuple(id(f) for f in callstack)
+        if frames != self._frames:
+            self._frames = frames
+        top = callstack[-1]
+        self.steps.append(TraceStep(event, top.f_code.co_name, top.f_lineno, changed, removed,
+                                    self._order, self._frames, graph.truncated))
+
+    def graphs(self):
+        """Replay the steps, yielding (TraceStep, ObjGraph, frame GraphNodes) for each"""
+        index = {}
+        for step in self.steps:
+            index.update(step.changed)
+            for i in step.removed:
+                del index[i]
+            graph = ObjGraph()
+            graph.index = index
+            graph.nodes = [index[i] for i in step.order]
+            graph.truncated = step.truncated
+            yield step, graph, [index[i] for i in step.frames]
+
+    def sources(self):
+        """Yield the graphviz source of each step in order"""
+        for step, graph, frames in self.graphs():
+            yield cached_source(write_stack_graph, graph, frames)
+
+    def source(self, i):
+        """Return the graphviz source of step i"""
+        if i < 0:
+            i += len(self.steps)
+        for j, source in enumerate(self.sources()):
+            if j == i:
+                return source
+        raise IndexError("step index out of range")
+
+    def render(self, directory='.', format='svg', prefix='step', workers=None, progress=None):
+        """Lay out every step into directory with render_batch(); return its results"""
+        return render_batch(list(self.sources()), directory=directory, format=format,
+                            prefix=prefix, workers=workers, progress=progress)
+
+    def gif(self, filename, duration=500, workers=None):
+        """Write an animated GIF with one frame per step shown for duration ms. Requires Pillow."""
+        try:
+            from PIL import Image
+        except ImportError:
+            raise ImportError("Tracer.gif() needs Pillow: pip install pillow")
+        import shutil
+        import tempfile
+        directory = tempfile.mkdtemp(prefix='lolviz')
+        try:
+            results = self.render(directory, format='png', workers=workers)
+            for _, error in results:
+                if error is not None:
+                    raise error
+            images = [Image.open(name).convert('RGB') for name, _ in results]
+            # frames must share one size; pad each onto a white canvas
+            width = max(im.size[0] for im in images)
+            height = max(im.size[1] for im in images)
+            frames = []
+            for im in images:
+                canvas = Image.new('RGB', (width, height), 'white')
+                canvas.paste(im, (0, 0))
+                frames.append(canvas)
+            frames[0].save(filename, save_all=True, append_images=frames[1:], duration=duration, loop=0)
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+
+def frozen_node(gnode, dot=None):
+    """
+    Copy gnode for a recording: without its object, so the copy neither
+    keeps the object alive nor changes with it, with the type as a name
+    and long strings cut to what will be displayed. dot is the node's
+    DOT from live_dot(), if it is drawn from the live object.
+    """
+    f = GraphNode.__new__(GraphNode)
+    f.__dict__.update(gnode.__dict__)
+    f.obj = None
+    f.draw = None
+    f.dot = dot
+    f.type = type_name(gnode.type)
+    fields = gnode.fields
+    if dot is not None:
+        f.fields = None
+    elif isinstance(fields, ListSample):
+        f.fields = copy.copy(fields)
+        f.fields.values = [frozen_atom(v) for v in fields.values]
+    elif gnode.kind in ('frame', 'dict', 'object'):
+        f.fields = [(label, frozen_atom(key, None), frozen_atom(v)) for label, key, v in fields]
+    elif fields is not None:
+        f.fields = [frozen_atom(v) for v in fields]
+    return f
+
+
+def live_dot(gnode):
+    """Return the DOT for gnode now if drawing it needs the live object, else None"""
+    if gnode.draw is not None or gnode.kind in ('ndarray', 'series', 'dataframe', 'other'):
+        return gr_obj_node(gnode)
+    return None
 
-    # Draw all stack frame nodes together so we can use rank=same
-    s += "\n{ rank=same;\n"
-    callstack = list(reversed(callstack))
-    for f in callstack:
-        s += obj_node(f, varnames)
 
-    for i in range(len(callstack)-1):
-        this = callstack[i]
-        callee = callstack[i+1]
-        s += 'node%d -> node%d [style=invis, weight=100]\n' % (id(this), id(callee))
-    s += "}\n\n"
+def frozen_atom(v, maxlen=-1):
+    """
+    Return a value that displays like atom v but is a plain str, int,
+    float, bool or None, or a FrozenAtom. Strings are cut to just over
+    maxlen chars (prefs.max_str_len by default), which still shows as
+    the same abbreviation.
+    """
+    t = type(v)
+    if t is str:
+        if maxlen == -1:
+            maxlen = prefs.max_str_len
+        if maxlen is not None and len(v) > maxlen+1:
+            return v[:maxlen+1]
+        return v
+    if v is None or t is int or t is float or t is bool or t is FrozenAtom:
+        return v
+    s = str(v)
+    if maxlen == -1 and len(s) > prefs.max_str_len+1:
+        s = s[:prefs.max_str_len+1]
+    return FrozenAtom(s, repr(v))
+
+
+def fields_sig(fields):
+    """
+    Return something equal to fields_sig(f) only if fields f display the
+    same. Atoms are compared by type and repr, since 1, 1.0 and True or
+    0.0 and -0.0 are equal but look different.
+    """
+    if isinstance(fields, ListSample):
+        return fields.N, tuple(fields.indexes), tuple(atom_sig(v) for v in fields.values)
+    if fields is None:
+        return None
+    return tuple(tuple(atom_sig(x) for x in f) if type(f) is tuple else atom_sig(f) for f in fields)
 
-    # find all reachable objects from call stack
-    reachable = []
-    for f in callstack:
-        cl = closure(f, varnames)
-        reachable.extend(cl)
-    reachable = uniq(reachable)
 
-    s += obj_nodes(reachable)
-    s += obj_edges(reachable)
-    s += obj_edges(callstack, varnames)
-    s += "}\n"
+def atom_sig(v):
+    t = type(v)
+    return v if t is str else (t, repr(v))
 
-    return graphviz.Source(s)
 
+_type_names = {}
 
-def ignoresym(sym):
-    return sym[0].startswith('_') or\
-           callable(sym[1]) or\
-           isinstance(sym[1], types.ModuleType)
+
+def type_name(t):
+    if isinstance(t, str):
+        return t
+    name = _type_names.get(t)
+    if name is None:
+        name = _type_names[t] = '%s.%s' % (t.__module__, getattr(t, '__qualname__', t.__name__))
+    return name
 
 
-def objviz(o, orientation="LR"):
-    """Draw an arbitrary object graph."""
-    s = """
+class Snapshot:
+    """
+    An object graph or call stack copied by snapshot() or
+    stack_snapshot(), detached from the live objects. Drawing it or
+    moving it elsewhere as JSON (dumps() and Snapshot.loads()) can
+    happen later, on another thread, process or machine.
+    """
+    def __init__(self, nodes, order, frames=(), truncated=False, orientation="LR"):
+        self.nodes = nodes # id -> frozen GraphNode, including frames
+        self.order = order # ids of the non-frame nodes in closure order
+        self.frames = frames # ids of stack frames, outermost first; empty for objects
+        self.truncated = truncated
+        self.orientation = orientation
+
+    def graph(self):
+        graph = ObjGraph()
+        graph.index = self.nodes
+        graph.nodes = [self.nodes[i] for i in self.order]
+        graph.truncated = self.truncated
+        return graph
+
+    def write(self, w):
+        graph = self.graph()
+        w.stats.nodes += len(graph.index)
+        w.stats.lap('graph')
+        if self.frames:
+            write_stack_graph(w, graph, [self.nodes[i] for i in self.frames])
+        else:
+            write_objgraph(w, graph, self.orientation)
+
+    def source(self):
+        """Return the graphviz source, which like objviz()'s can be rendered or displayed"""
+        return cached_source(self.write)
+
+    def dumps(self):
+        """Return this snapshot as a JSON string"""
+        nodes = []
+        for gnode in self.nodes.values():
+            fields = gnode.fields
+            if isinstance(fields, ListSample):
+                fields = {'N': fields.N, 'indexes': fields.indexes, 'values': [json_atom(v) for v in fields.values]}
+            elif gnode.kind in ('frame', 'dict', 'object') and fields is not None:
+                fields = [[label, json_atom(key), json_atom(v)] for label, key, v in fields]
+            elif fields is not None:
+                fields = [json_atom(v) for v in fields]
+            nodes.append({'id': gnode.id, 'type': gnode.type, 'kind': gnode.kind, 'name': gnode.name,
+                          'fields': fields, 'edges': gnode.edges, 'highlight': gnode.highlight,
+                          'dot': gnode.dot, 'size': gnode.size, 'retained': gnode.retained,
+                          'more': gnode.more})
+        return json.dumps({'lolviz': 1, 'nodes': nodes, 'order': self.order, 'frames': self.frames,
+                           'truncated': self.truncated, 'orientation': self.orientation})
+
+    @classmethod
+    def loads(cls, text):
+        """Return the Snapshot encoded in text by dumps()"""
+        data = json.loads(text)
+        nodes = {}
+        for d in data['nodes']:
+            fields = d['fields']
+            if isinstance(fields, dict):
+                sample = ListSample([])
+                sample.N = fields['N']
+                sample.indexes = fields['indexes']
+                sample.values = [unjson_atom(v) for v in fields['values']]
+                fields = sample
+            elif d['kind'] in ('frame', 'dict', 'object') and fields is not None:
+                fields = [(label, unjson_atom(key), unjson_atom(v)) for label, key, v in fields]
+            elif fields is not None:
+                fields = [unjson_atom(v) for v in fields]
+            gnode = GraphNode(None, d['kind'], d['name'], fields, [tuple(e) for e in d['edges']])
+            gnode.id = d['id']
+            gnode.type = d['type']
+            gnode.highlight = d['highlight']
+            gnode.dot = d['dot']
+            gnode.size = d.get('size')
+            gnode.retained = d.get('retained')
+            gnode.more = d.get('more', 0)
+            nodes[gnode.id] = gnode
+        return cls(nodes, data['order'], data['frames'], data['truncated'], data['orientation'])
+
+
+def json_atom(v):
+    if isinstance(v, FrozenAtom):
+        return {'str': v.s, 'repr': v.r}
+    return v
+
+
+def unjson_atom(v):
+    if isinstance(v, dict):
+        return FrozenAtom(v['str'], v['repr'])
+    return v
+
+
+def snapshot(o, orientation="LR", max_nodes=None, max_depth=None):
+    """
+    Copy what objviz(o) would draw into a Snapshot and return. Only the
+    walk and a copy of the displayed values happen now; no graphviz
+    source is built, so the pause for a live process stays short.
+    """
+    if not viz_exists_for_object(o) and hasattr(o, "__iter__"):
+        o = list(o)
+    graph = ObjGraph(max_nodes=max_nodes, max_depth=max_depth)
+    nodes = without_gc(copy_graph, graph, [o])
+    return Snapshot(nodes, [gnode.id for gnode in graph.nodes], [], graph.truncated, orientation)
+
+
+def copy_graph(graph, roots):
+    """Add roots to graph and return id -> frozen GraphNode for all it holds"""
+    for p in roots:
+        graph.add(p)
+    graph.measure()
+    return dict((i, frozen_node(gnode, live_dot(gnode))) for i, gnode in graph.index.items())
+
+
+def without_gc(f, *args):
+    """
+    Call f(*args) with the cyclic garbage collector paused. Copying a big
+    graph allocates many containers, which otherwise triggers repeated
+    full collections over the whole heap of a large process.
+    """
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        return f(*args)
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def stack_snapshot(callstack=None, varnames=None, max_nodes=None, max_depth=None):
+    """Like snapshot() but copies what callsviz() would draw"""
+    if callstack is None:
+        callstack = caller_frames(sys._getframe(1))
+    callstack = list(reversed(callstack))
+    graph = ObjGraph(varnames, max_nodes, max_depth)
+    nodes = without_gc(copy_graph, graph, callstack)
+    return Snapshot(nodes, [gnode.id for gnode in graph.nodes], [id(f) for f in callstack],
+                    graph.truncated)
+
+
+def objviz(o, orientation="LR", max_nodes=None, max_depth=None):
+    """
+    Draw an arbitrary object graph. To keep huge heaps drawable, stop
+    expanding after max_nodes objects or at objects more than max_depth
+    pointers from o, showing "N more objects" stubs where it stopped.
+    """
+    return cached_source(write_objviz, o, orientation, max_nodes, max_depth)
+
+
+def write_objviz(w, o, orientation="LR", max_nodes=None, max_depth=None):
+    if isndarray(o):
+        return write_matrixviz(w, o)
+    if not viz_exists_for_object(o) and hasattr(o, "__iter__"):
+        o = list(o)
+
+    graph = ObjGraph(max_nodes=max_nodes, max_depth=max_depth)
+    graph.add(o)
+    w.stats.nodes += len(graph.index)
+    w.stats.lap('graph')
+    write_objgraph(w, graph, orientation)
+
+
+def write_objgraph(w, graph, orientation="LR"):
+    w.write("""
 digraph G {
     nodesep=.1;
     ranksep=.3;
     rankdir=%s;
     node [penwidth="0.5", shape=box, width=.1, height=.1];
     
-""" % orientation
+""" % orientation)
 
-    if type(o).__module__ == 'numpy': # avoid requiring numpy package unless used
-        if type(o).__name__ == 'ndarray':
-            return matrixviz(o)
-    if not viz_exists_for_object(o) and hasattr(o, "__iter__"):
-        o = list(o)
+    write_obj_nodes(w, graph)
+    write_obj_edges(w, graph)
+    w.write("}\n")
 
-    reachable = closure(o)
 
-    s += obj_nodes(reachable)
-    s += obj_edges(reachable)
-    s += "}\n"
-    return graphviz.Source(s)
+def obj_nodes(nodes):
+    """
+    Return DOT for the nodes of an ObjGraph, or of a list of objects
+    such as that returned by closure().
+    """
+    return dot_source(write_obj_nodes, nodes)
 
 
-def obj_nodes(nodes):
-    s = ""
+def write_obj_nodes(w, nodes):
+    graph = as_objgraph(nodes)
+    if graph is not nodes:
+        nodes = [graph.node(p) for p in nodes]
+        w.stats.nodes += len(graph.index)
+        w.stats.lap('graph')
+    else:
+        nodes = graph.nodes
 
     # organize nodes by connected_subgraphs so we can cluster
     # currently only making subgraph cluster for linked lists
     # otherwise it squishes trees.
-    max_edges_for_type,subgraphs = connected_subgraphs(nodes)
+    max_edges_for_type,subgraphs,cluster_of = graph_subgraphs(graph)
+    w.stats.lap('subgraphs')
     c = 1
     for g in subgraphs:
         firstelement = g[0]
-        if max_edges_for_type[firstelement.__class__]==1: # linked list
-            s += 'subgraph cluster%d {style=invis penwidth=.7 pencolor="%s"\n' % (c,GREEN)
-            for p in g:
-                s += obj_node(p)
-            s += "\n}\n"
+        if max_edges_for_type[firstelement.type]==1: # linked list
+            w.write('subgraph cluster%d {style=invis penwidth=.7 pencolor="%s"\n' % (c,GREEN))
+            for gnode in g:
+                w.write(gr_obj_node(gnode))
+            w.write("\n}\n")
             c += 1
-        elif max_edges_for_type[firstelement.__class__]==2: # binary tree
-            for p in g:
-                s += obj_node(p) # nothing special for now
+        else: # binary tree or denser
+            for gnode in g:
+                w.write(gr_obj_node(gnode)) # nothing special for now
 
     # now dump disconnected nodes
-    for p in nodes:
-        found = False
-        for g in subgraphs:
-            if p in g:
-                found = True
-                break
-        if not found:
-            s += obj_node(p)
-
-    return s
+    for gnode in nodes:
+        if gnode.id not in cluster_of:
+            w.write(gr_obj_node(gnode))
+    if prefs.show_sizes:
+        write_sizes(w, graph)
+    w.stats.lap('nodes')
 
 
 def obj_node(p, varnames=None):
+    gnode, _ = graph_node(p, varnames)
+    return gr_obj_node(gnode)
+
+
+def gr_obj_node(gnode):
+    """Return DOT for one GraphNode according to its kind"""
     s = ""
-    nodename = "node%d" % id(p)
-    if type(p) == types.FrameType:
-        frame = p
-        info = inspect.getframeinfo(frame)
-        caller_scopename = info[2]
+    nodename = "node%d" % gnode.id
+    kind = gnode.kind
+    if gnode.dot is not None:
+        s += gnode.dot
+    elif gnode.draw is not None:
+        s += gnode.draw(nodename, gnode)
+    elif kind == 'frame':
+        caller_scopename = gnode.name
         if caller_scopename == '<module>':
             caller_scopename = 'globals'
-        argnames, _, _ = inspect.getargs(frame.f_code)
-        items = []
-        # do args first to get proper order
-        for arg in argnames:
-            if varnames is not None and arg not in varnames: continue
-            v = frame.f_locals[arg]
-            if isatom(v):
-                items.append((arg, arg, v))
-            else:
-                items.append((arg, arg, None))
-        for k, v in frame.f_locals.items():
-            if varnames is not None and k not in varnames: continue
-            if k in argnames:
-                continue
-            if ignoresym((k, v)):
-                continue
-            if isatom(v):
-                items.append((k, k, v))
-            else:
-                items.append((k, k, None))
         s += '// FRAME %s\n' % caller_scopename
-        s += gr_dict_node(nodename, caller_scopename, items, highlight=argnames, bgcolor=BLUE,
+        s += gr_dict_node(nodename, caller_scopename, gnode.fields, highlight=gnode.highlight, bgcolor=BLUE,
                           separator=None, reprkey=False)
-    elif isinstance(p,dict):
+    elif kind == 'dict':
         # print "DRAW DICT", p, '@ node' + nodename
-        items = []
-        i = 0
-        for k, v in p.items():
-            if varnames is not None and k not in varnames: continue
-            if isatom(v):
-                items.append((str(i), k, v))
-            else:
-                items.append((str(i), k, None))
-            i += 1
         s += '// DICT\n'
-        s += gr_dict_node(nodename, None, items)
-    elif isinstance(p,set) and len(p) == 0:  # special case "empty set"
-        s += 'node%d [margin="0.03", shape=none label=<<font face="Times-Italic" color="#444443" point-size="9">empty set</font>>];\n' % id(p)
-    elif p is True or p is False:  # Boolean
-        s += 'node%d [margin="0.03", shape=none label=<<font face="Times-Italic" color="#444443" point-size="9">%s</font>>];\n' % (id(p), str(p))
-    elif type(p).__module__ == 'numpy' and type(p).__name__ == 'ndarray':
-        s += gr_ndarray_node('node%d' % id(p), p)
-    elif type(p).__module__ == 'pandas.core.series' and type(p).__name__ == 'Series':
-        s += gr_ndarray_node('node%d' % id(p), p.values)
-    elif type(p).__module__ == 'pandas.core.frame' and type(p).__name__ == 'DataFrame':
-        s += gr_ndarray_node('node%d' % id(p), p.values)
-    elif isinstance(p,list) and len(p)==0: # special case "empty list"
-        s += 'node%d [margin="0.03", shape=none label=<<font face="Times-Italic" color="#444443" point-size="9">empty list</font>>];\n' % id(p)
-    elif hasattr(p, "__iter__") and isatomlist(p) or type(p)==tuple:
+        s += gr_dict_node(nodename, None, gnode.fields, more=gnode.more)
+    elif kind == 'emptyset':  # special case "empty set"
+        s += '%s [margin="0.03", shape=none label=<<font face="Times-Italic" color="#444443" point-size="9">empty set</font>>];\n' % nodename
+    elif kind == 'bool':  # Boolean
+        s += '%s [margin="0.03", shape=none label=<<font face="Times-Italic" color="#444443" point-size="9">%s</font>>];\n' % (nodename, gnode.name)
+    elif kind == 'ndarray':
+        s += gr_ndarray_node(nodename, gnode.obj)
+    elif kind == 'series' or kind == 'dataframe':
+        s += gr_dataframe_node(nodename, gnode.obj)
+    elif kind == 'emptylist': # special case "empty list"
+        s += '%s [margin="0.03", shape=none label=<<font face="Times-Italic" color="#444443" point-size="9">empty list</font>>];\n' % nodename
+    elif kind == 'atomset':
+        s += '// SET of atoms\n'
+        s += gr_set_node(nodename, gnode.fields)
+    elif kind == 'atomlist':
         # print "DRAW LIST", p, '@ node' + nodename
-        elems = []
-        for el in p:
-            if isatom(el):
-                elems.append(el)
-            else:
-                elems.append(None)
-        if isinstance(p,set):
-            s += '// SET of atoms\n'
-            s += gr_set_node(nodename, elems)
-        else:
-            s += '// LIST or ITERATABLE of atoms\n'
-            s += gr_list_node(nodename, elems)
-    elif hasattr(p, "__iter__"):
+        s += '// LIST or ITERATABLE of atoms\n'
+        s += gr_list_node(nodename, gnode.fields)
+    elif kind == 'vset':
+        s += '// VERTICAL LIST or ITERATABLE\n'
+        s += gr_vlol_node(nodename, gnode.fields, title='set', showindexes=False)
+    elif kind == 'vlist':
         # print "DRAW VERTICAL LIST", p, '@ node' + nodename
-        elems = []
-        for el in p:
-            if isatom(el):
-                elems.append(el)
-            else:
-                elems.append(None)
         s += '// VERTICAL LIST or ITERATABLE\n'
-        if isinstance(p,set):
-            s += gr_vlol_node(nodename, elems, title='set', showindexes=False)
-        else:
-            s += gr_vlol_node(nodename, elems)
-
-    elif hasattr(p, "__dict__"): # generic object
+        s += gr_vlol_node(nodename, gnode.fields)
+    elif kind == 'object': # generic object
         # print "DRAW OBJ", p, '@ node' + nodename
-        items = []
-        for k, v in p.__dict__.items():
-            if isatom(v):
-                items.append((k, k, v))
-            else:
-                items.append((k, k, None))
-        s += '// %s OBJECT with fields\n' % p.__class__.__name__
-        s += gr_dict_node(nodename, p.__class__.__name__, items, separator=None,
-                          reprkey=False)
+        s += '// %s OBJECT with fields\n' % gnode.name
+        s += gr_dict_node(nodename, gnode.name, gnode.fields, separator=None,
+                          reprkey=False, more=gnode.more)
     else:
-        s += 'node%d [margin="0.03", shape=none label=<<font face="Times-Italic" color="#444443" point-size="9">%s</font>>];\n' % (id(p),abbrev_and_escape("<%s:%s>" % (type(p).__name__,repr(p))))
+        s += '%s [margin="0.03", shape=none label=<<font face="Times-Italic" color="#444443" point-size="9">%s</font>>];\n' % (nodename,abbrev_and_escape("<%s:%s>" % (gnode.name,repr(gnode.obj))))
 
     return s
 
 
 def obj_edges(nodes, varnames=None):
-    s = ""
-    es = edges(nodes, varnames)
-    for (p, label, q) in es:
-        if type(p) != types.FrameType and type(p) != dict and type(p) != tuple and hasattr(p,"__iter__") and not isatomlist(p):  # edges start at right edge not center for vertical lists
-            s += 'node%d:%s -> node%d:w [arrowtail=dot, penwidth="0.5", color="#444443", arrowsize=.4, weight=100]\n' % (id(p), label, id(q))
+    """
+    Return DOT for the edges out of an ObjGraph's nodes, a list of
+    GraphNodes, or a list of objects.
+    """
+    return dot_source(write_obj_edges, nodes, varnames)
+
+
+def write_obj_edges(w, nodes, varnames=None, graph=None, stubs=None):
+    """
+    If nodes came from a graph truncated by max_nodes or max_depth,
+    pointers to objects left out of it go to a "N more objects" stub.
+    Each such object is counted by the stub of the first node pointing
+    to it; later pointers to it go to that stub too. stubs maps the ids
+    of objects left out to their stub, to share between calls.
+    """
+    if isinstance(nodes, ObjGraph):
+        graph = nodes
+        nodes = graph.nodes
+    if stubs is None:
+        stubs = {}
+    for gnode in nodes:
+        if not isinstance(gnode, GraphNode):
+            gnode, _ = graph_node(gnode, varnames)
+        es = ['node%d' % qid for _, qid in gnode.edges]
+        if graph is not None and graph.truncated:
+            stub = 'elided%d' % gnode.id
+            n = 0
+            for _, qid in gnode.edges:
+                if qid not in graph.index and qid not in stubs:
+                    stubs[qid] = stub
+                    n += 1
+            if n:
+                w.write(gr_elided_node(gnode, n))
+            es = [stubs.get(qid, q) for (_, qid), q in zip(gnode.edges, es)]
+        if gnode.kind == 'vlist' or gnode.kind == 'vset':  # edges start at right edge not center for vertical lists
+            for (label, _), q in zip(gnode.edges, es):
+                w.write('node%d:%s -> %s:w [arrowtail=dot, penwidth="0.5", color="#444443", arrowsize=.4, weight=100]\n' % (gnode.id, label, q))
         else:
-            s += 'node%d:%s:c -> node%d [dir=both, tailclip=false, arrowtail=dot, penwidth="0.5", color="#444443", arrowsize=.4]\n' % (id(p), label, id(q))
+            for (label, _), q in zip(gnode.edges, es):
+                w.write('node%d:%s:c -> %s [dir=both, tailclip=false, arrowtail=dot, penwidth="0.5", color="#444443", arrowsize=.4]\n' % (gnode.id, label, q))
+        w.stats.edges += len(gnode.edges)
+    w.stats.lap('edges')
 
-    return s
+
+def gr_elided_node(gnode, n):
+    """Stub standing in for the n objects pointed to by gnode that weren't expanded"""
+    label = '%d more object%s' % (n, '' if n==1 else 's')
+    return 'elided%d [margin="0.03", shape=none label=<<font face="Times-Italic" color="#444443" point-size="9">%s</font>>];\n' % (gnode.id, label)
 
 
 def elviz(el, showassoc):
@@ -427,36 +1958,65 @@ def elviz(el, showassoc):
 
 def gr_list_node(nodename, elems, bgcolor=YELLOW):
     shape="box"
+    elems = list_sample(elems)
     if len(elems)>0:
-        abbrev_values = abbrev_and_escape_values(elems) # compute just to see eventual size
-        if len(''.join(abbrev_values))>prefs.max_horiz_array_len:
-            html = gr_vlist_html(elems, bgcolor=bgcolor)
-        else:
-            html = gr_listtable_html(elems, bgcolor=bgcolor)
+        html = cached_fragment(gr_list_html, elems, bgcolor)
     else:
         shape = "none"
         html = '<font face="Times-Italic" color="#444443" point-size="9">empty list</font>'
     return '%s [shape="%s", space="0.0", margin="0.01", fontcolor="#444443", fontname="Helvetica", label=<%s>];\n' % (nodename,shape,html)
 
 
+def gr_list_html(elems, bgcolor=YELLOW):
+    abbrev_values = abbrev_and_escape_values(elems.values) # compute just to see eventual size
+    if len(''.join(abbrev_values))>prefs.max_horiz_array_len:
+        return gr_vlist_html(elems, bgcolor=bgcolor)
+    return gr_listtable_html(elems, bgcolor=bgcolor)
+
+
+def cached_fragment(f, sample, bgcolor):
+    """
+    Return f(sample, bgcolor), the HTML table for a ListSample, from
+    fragment_cache if the same values were drawn that way under the same
+    prefs. Only samples of exact ints, strs, bools, floats and None are
+    cached; values that are equal but print differently, such as 1, 1.0
+    and True, get different keys. Anything else is drawn each time.
+    """
+    values = []
+    for v in sample.values:
+        t = type(v)
+        if t not in _fragment_types:
+            return f(sample, bgcolor)
+        values.append((t, repr(v) if t is float else v))
+    key = (f.__name__, bgcolor, current_prefs().key(), sample.N, tuple(sample.indexes), tuple(values))
+    try:
+        html = fragment_cache.get(key)
+    except TypeError: # a pref holds an unhashable value
+        return f(sample, bgcolor)
+    if html is None:
+        html = f(sample, bgcolor)
+        fragment_cache.put(key, html)
+    return html
+
+_fragment_types = frozenset([int, str, bool, float, type(None)])
+
+
 def gr_listtable_html(values, title=None, bgcolor=YELLOW, showindexes=True):
     header = '<table BORDER="0" CELLBORDER="0" CELLSPACING="0">\n'
     tail = "</table>\n"
 
-    N = len(values)
+    sample = list_sample(values)
+    N = len(sample)
     index_html = '<td cellspacing="0" cellpadding="0" bgcolor="%s" border="1" sides="br" valign="top"><font color="#444443" point-size="9">%s</font></td>\n'
     value_html = '<td port="%s" bgcolor="%s" border="1" sides="r" align="center"><font point-size="11">%s</font></td>\n'
     # don't want right border to show on last.
     last_index_html = '<td cellspacing="0" cellpadding="0" bgcolor="%s" border="1" sides="b" valign="top"><font color="#444443" point-size="9">%d</font></td>\n'
     last_value_html = '<td port="%s" bgcolor="%s" border="0" align="center"><font point-size="11">%s</font></td>\n'
 
-    oversize = False
-    if N > prefs.max_list_elems:
-        values = values[0:prefs.max_list_elems-1] + [values[N - 1]]
-        oversize = True
+    oversize = sample.oversize()
 
     newvalues = []
-    for value in values:
+    for value in sample.values:
         if value is not None:
             if len(str(value)) > prefs.max_str_len:
                 value = abbrev_and_escape(str(value))
@@ -479,7 +2039,7 @@ def gr_listtable_html(values, title=None, bgcolor=YELLOW, showindexes=True):
         bottomrow.append(last_value_html % (N-1, bgcolor,values[lastindex]))
 
     if title is not None:
-        titlerow = '<tr><td cellspacing="0" colspan="%d" cellpadding="0" bgcolor="%s" border="1" sides="b" align="center"><font color="#444443" FACE="Times-Italic" point-size="11">%s</font></td></tr>\n' % (N, bgcolor, title)
+        titlerow = '<tr><td cellspacing="0" colspan="%d" cellpadding="0" bgcolor="%s" border="1" sides="b" align="center"><font color="#444443" FACE="Times-Italic" point-size="11">%s</font></td></tr>\n' % (len(bottomrow), bgcolor, title)
     else:
         titlerow = ''
 
@@ -491,24 +2051,33 @@ def gr_listtable_html(values, title=None, bgcolor=YELLOW, showindexes=True):
 
 def gr_set_node(nodename, elems, bgcolor=YELLOW):
     shape="box"
+    elems = list_sample(elems)
     if len(elems)>0:
-        abbrev_values = abbrev_and_escape_values(elems) # compute just to see eventual size
-        if len(''.join(abbrev_values))>prefs.max_horiz_array_len:
-            html = gr_vlist_html(elems, title='set', bgcolor=bgcolor, showindexes=False, showelems=True)
-        else:
-            html = gr_listtable_html(elems, title='set', bgcolor=bgcolor, showindexes=False)
+        html = cached_fragment(gr_set_html, elems, bgcolor)
     else:
         shape = "none"
         html = '<font face="Times-Italic" color="#444443" point-size="9">empty list</font>'
     return '%s [shape="%s", space="0.0", margin="0.01", fontcolor="#444443", fontname="Helvetica", label=<%s>];\n' % (nodename,shape,html)
 
 
-def gr_dict_node(nodename, title, items, highlight=None, bgcolor=YELLOW, separator="&rarr;", reprkey=True):
-    html = gr_dict_html(title, items, highlight, bgcolor, separator, reprkey)
+def gr_set_html(elems, bgcolor=YELLOW):
+    abbrev_values = abbrev_and_escape_values(elems.values) # compute just to see eventual size
+    if len(''.join(abbrev_values))>prefs.max_horiz_array_len:
+        return gr_vlist_html(elems, title='set', bgcolor=bgcolor, showindexes=False, showelems=True)
+    return gr_listtable_html(elems, title='set', bgcolor=bgcolor, showindexes=False)
+
+
+def gr_dict_node(nodename, title, items, highlight=None, bgcolor=YELLOW, separator="&rarr;", reprkey=True, more=0):
+    html = gr_dict_html(title, items, highlight, bgcolor, separator, reprkey, more)
     return '%s [margin="0.03", color="#444443", fontcolor="#444443", fontname="Helvetica", style=filled, fillcolor="%s", label=<%s>];\n' % (nodename,bgcolor,html)
 
 
-def gr_dict_html(title, items, highlight=None, bgcolor=YELLOW, separator="&rarr;", reprkey=True):
+def gr_dict_html(title, items, highlight=None, bgcolor=YELLOW, separator="&rarr;", reprkey=True, more=0):
+    """
+    Show (port label, key, value) items as rows of key and value, atoms
+    first. If more, the items are a sample and a last row says how many
+    entries were left out.
+    """
     header = '<table BORDER="0" CELLPADDING="0" CELLBORDER="1" CELLSPACING="0">\n'
 
     blankrow = '<tr><td colspan="3" cellpadding="1" border="0" bgcolor="%s"></td></tr>' % (bgcolor)
@@ -548,6 +2117,8 @@ def gr_dict_html(title, items, highlight=None, bgcolor=YELLOW, separator="&rarr;
             rows.append(row)
     else:
         rows.append('<tr><td cellspacing="0" cellpadding="0" border="0"><font point-size="9"> ... </font></td></tr>\n')
+    if more:
+        rows.append('<tr><td colspan="3" cellspacing="0" cellpadding="0" bgcolor="%s" border="0" align="center"><font color="#444443" point-size="9">&#8942; %d more</font></td></tr>\n' % (bgcolor, more))
 
     tail = "</table>\n"
     return header + blankrow.join(rows) + tail
@@ -602,11 +2173,10 @@ def gr_vlist_html(elems, title=None, bgcolor=YELLOW, showindexes=True, showelems
         title = '<tr><td cellspacing="0" colspan="3" cellpadding="0" bgcolor="%s" border="1" sides="b" align="center"><font color="#444443" FACE="Times-Italic" point-size="11">%s</font></td></tr>\n' % (bgcolor, title)
         rows.append(title)
 
-    N = len(elems)
-    if N > prefs.max_list_elems:
-        items = [(i,elems[i]) for i in range(prefs.max_list_elems-1)] + [(Ellipsis(),Ellipsis()),(N-1,elems[N - 1])]
-    else:
-        items = [(i,elems[i]) for i in range(N)]
+    sample = list_sample(elems)
+    items = list(zip(sample.indexes, sample.values))
+    if sample.oversize():
+        items.insert(-1, (Ellipsis(),Ellipsis()))
 
     if len(items)>0:
         for i,e in items:
@@ -708,13 +2278,83 @@ def gr_vtree_html(title, items, bgcolor=YELLOW, separator=None, leftfield='left'
     return header + blankrow.join(rows) + kidsep + kidnames + kidptrs + bottomsep + tail
 
 
-def string_node(s):
-    html = string_html(s)
+def string_node(s, start=None, stop=None, showhex=False, wrap=None):
+    html = string_html(s, start, stop, showhex, wrap)
     return '    node%d [width=0,height=0, color="#444443", fontcolor="#444443", fontname="Helvetica", style=filled, fillcolor="%s", label=<%s>];\n' % (id(s),YELLOW,html)
 
 
-def string_html(s):
-    values = list(s)
+def string_window(s, start=None, stop=None):
+    """
+    Return (prefix, [(offset, piece), ...]) for the part of s that
+    strviz() shows: s[start:stop], or its head and tail if longer than
+    prefs.max_strviz_len, with (None, None) where the middle is cut.
+    A piece is a str slice, or for bytes-like s a memoryview of bytes.
+    """
+    piece = lambda a, b: s[a:b]
+    if isinstance(s, (bytes, bytearray, memoryview)) and not isinstance(s, str):
+        prefix = "b'"
+        s = memoryview(s)
+        if s.format != 'B' or s.ndim != 1:
+            try:
+                s = s.cast('B')
+            except (TypeError, ValueError): # not contiguous
+                m = s
+                piece = lambda a, b: buffer_bytes(m, a, b)
+                s = range(m.nbytes) # just for its length
+    else:
+        prefix = "'"
+    start, stop, _ = slice(start, stop).indices(len(s))
+    n = max(0, stop - start)
+    maxlen = prefs.max_strviz_len
+    if n <= maxlen:
+        return prefix, [(start, piece(start, stop))]
+    ntail = maxlen // 2
+    return prefix, [(start, piece(start, start+maxlen-ntail)), (None, None), (stop-ntail, piece(stop-ntail, stop))]
+
+
+def buffer_bytes(m, start, stop):
+    """
+    Return bytes start:stop of m.tobytes() as a memoryview, for a
+    non-contiguous memoryview m, reading just the items they fall in.
+    """
+    size = m.itemsize
+    first, last = start // size, (stop + size - 1) // size
+    items = []
+    for i in range(first, last):
+        index = [] # i as an index into m's shape, last dimension fastest
+        for n in reversed(m.shape):
+            i, j = divmod(i, n)
+            index.append(j)
+        items.append(struct.pack(m.format, m[tuple(reversed(index))]))
+    return memoryview(b''.join(items))[start - first*size:stop - first*size]
+
+
+def char_html(c, showhex=False):
+    """How strviz() shows a char or a byte (an int): itself if printable, else its escape"""
+    if isinstance(c, int):
+        if showhex:
+            return '%02x' % c
+        c = chr(c) if 32 <= c < 127 else '\\x%02x' % c
+    elif showhex:
+        return '%02x' % ord(c)
+    elif not c.isprintable():
+        c = repr(c)[1:-1]
+    return c.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+
+def string_html(s, start=None, stop=None, showhex=False, wrap=None):
+    """
+    Return an HTML table of the chars or bytes strviz() shows, each under
+    its offset in s, in rows of wrap cells if wrap.
+    """
+    prefix, window = string_window(s, start, stop)
+    pieces = [] # lists of (index, value) with [(None, '...')] for the cut
+    for offset, piece in window:
+        if piece is None:
+            pieces.append([(None, '...')])
+            continue
+        chars = piece.tolist() if isinstance(piece, memoryview) else piece
+        pieces.append([(offset+i, char_html(c, showhex)) for i, c in enumerate(chars)])
     header = '<table BORDER="0" CELLPADDING="0" CELLBORDER="0" CELLSPACING="0">\n'
 
     index_html = '<td cellspacing="0" cellpadding="0" bgcolor="#FBFEB0" border="1" sides="br" valign="top"><font color="#444443" point-size="9">%d</font></td>\n'
@@ -723,135 +2363,309 @@ def string_html(s):
     last_index_html = '<td cellspacing="0" cellpadding="0" bgcolor="#FBFEB0" border="1" sides="b" valign="top"><font color="#444443" point-size="9">%d</font></td>\n'
     last_value_html = '<td port="%d" cellspacing="0" cellpadding="0" bgcolor="#FBFEB0" border="0" align="center"><font face="Monaco" point-size="11">%s</font></td>\n'
 
-    lastindex = len(values) - 1
-    toprow = [index_html % i for i in range(lastindex)]
-    bottomrow = [value_html % (i,values[i]) for i in range(lastindex)]
+    cut_index_html = '<td cellspacing="0" cellpadding="0" bgcolor="#FBFEB0" border="1" sides="br" valign="top"><font color="#444443" point-size="9">...</font></td>\n'
+    cut_value_html = '<td cellspacing="0" cellpadding="0" bgcolor="#FBFEB0" border="0" align="center"><font face="Monaco" point-size="11">...</font></td>\n'
 
-    toprow.append(last_index_html % lastindex)
-    bottomrow.append(last_value_html % (lastindex, values[lastindex]))
+    if wrap: # the cut gets a row of its own so the tail lines up with the head
+        rows = [cells[i:i+wrap] for cells in pieces for i in range(0, len(cells), wrap)]
+    else:
+        rows = [[cell for cells in pieces for cell in cells]]
+    rows = rows or [[]]
+    out = [header]
+    for r, row in enumerate(rows):
+        toprow = []
+        bottomrow = []
+        for i, (index, value) in enumerate(row):
+            if index is None:
+                toprow.append(cut_index_html)
+                bottomrow.append(cut_value_html)
+            elif i == len(row) - 1:
+                toprow.append(last_index_html % index)
+                bottomrow.append(last_value_html % (index, value))
+            else:
+                toprow.append(index_html % index)
+                bottomrow.append(value_html % (index, value))
+        left = prefix if r == 0 else ''
+        right = "'" if r == len(rows) - 1 else ''
+        if r > 0:
+            out.append('\n')
+        out.append('<tr><td></td>\n'+''.join(toprow)+'<td></td></tr>\n' + '<tr><td>%s</td>\n' % left +
+                   ''.join(bottomrow)+'<td>%s</td></tr>' % right)
 
     tail = "</table>\n"
-    return header + '<tr><td></td>\n'+''.join(toprow)+'<td></td></tr>\n' + '<tr><td>\'</td>\n'+''.join(bottomrow)+'<td>\'</td></tr>' + tail
+    return ''.join(out) + tail
 
 
 def gr_1darray_html(data, bgcolor=YELLOW):
     if 'numpy' not in sys.modules:
         import numpy
     np = sys.modules['numpy']
-    if not isinstance(data,np.ndarray):
-        return " "
-    if data.ndim > 1:
-        return gr_1darray_html(data, bgcolor)
-    if data.ndim > 2:
+    if not isarraylike(data):
         return " "
+    if len(data.shape) > 1:
+        return gr_2darray_html(data, bgcolor)
 
-    ncols = len(data)
     header = '<table BORDER="0" CELLPADDING="0" CELLBORDER="1" CELLSPACING="0">\n'
     tail = "</table>\n"
 
     # grab slice of max elements from matrix
-    coloversize = False
+    block, _, coloversize = array_corners(data)
+    values = format_array(block)
     midpoint = prefs.max_list_elems//2
-    if ncols > prefs.max_list_elems:
-        colslice = list(np.arange(0,midpoint)) + list(np.arange(ncols-midpoint,ncols))
-        data = data[colslice]
-        ncols=len(colslice)
-        coloversize = True
-
-    cells = []
-    for j in range(ncols):
-        if coloversize and j==midpoint:
-            cells.append( '<td cellspacing="0" cellpadding="2" bgcolor="%s" border="0" align="center"><font color="#444443" point-size="10">...</font></td>\n' % bgcolor)
-        value = data[j]
-        if isinstance(value, float):
-            if str(value).endswith('.0'):
-                value = str(value)[:-1]
-            else:
-                value = round(value, prefs.float_precision)
-        if isinstance(value, float) and str(value).endswith('.0'):
-            value = str(value)[:-1]
-        if len(str(value)) > prefs.max_str_len:
-            value = abbrev_and_escape(str(value))
-        cell = '<td cellspacing="0" cellpadding="3" bgcolor="%s" border="0" align="center"><font color="#444443" point-size="10">%s</font></td>\n' % (bgcolor, value)
-        cells.append( cell )
+
+    ellipsis = '<td cellspacing="0" cellpadding="2" bgcolor="%s" border="0" align="center"><font color="#444443" point-size="10">...</font></td>\n' % bgcolor
+    cell = '<td cellspacing="0" cellpadding="3" bgcolor="%s" border="0" align="center"><font color="#444443" point-size="10">%%s</font></td>\n' % bgcolor
+    cells = [cell % value for value in values]
+    if coloversize:
+        cells.insert(midpoint, ellipsis)
 
     row = '<tr>' + ''.join(cells) + '</tr>\n'
 
     return header + row + tail
 
 
-def gr_2darray_html(data, bgcolor=YELLOW):
+def gr_2darray_html(data, bgcolor=YELLOW, index=()):
+    """
+    Show a 2-D array, or the 2-D slice data[index] of a bigger one, as
+    a table. Only the displayed corners of the slice are read.
+    """
     if 'numpy' not in sys.modules:
         import numpy
     np = sys.modules['numpy']
-    if len(data)==0:
+    if not isarraylike(data):
         return " "
-    if not isinstance(data,np.ndarray):
+    ndim = len(data.shape) - len(index)
+    if ndim > 0 and data.shape[len(index)]==0:
         return " "
-    if data.ndim == 1:
+    if ndim <= 1:
         return gr_1darray_html(data, bgcolor)
-    if data.ndim > 2:
-        return " "
+    if ndim > 2:
+        return gr_ndarray_html(data, bgcolor)
 
-    nrows,ncols = data.shape
     header = '<table BORDER="0" CELLPADDING="0" CELLBORDER="1" CELLSPACING="0">\n'
     tail = "</table>\n"
 
     # grab slice of max elements from matrix
-    coloversize = rowoversize = False
+    block, rowoversize, coloversize = array_corners(data, index)
+    values = format_array(block)
+    nrows, ncols = block.shape
     midpoint = prefs.max_list_elems//2
-    if nrows > prefs.max_list_elems:
-        rowslice = list(np.arange(0,midpoint)) + list(np.arange(nrows-midpoint,nrows))
-        data = data[rowslice]
-        nrows=len(rowslice)
-        rowoversize = True
-    if ncols > prefs.max_list_elems:
-        colslice = list(np.arange(0,midpoint)) + list(np.arange(ncols-midpoint,ncols))
-        data = data[:,colslice]
-        ncols=len(colslice)
-        coloversize = True
 
+    ellipsis = '<td cellspacing="0" cellpadding="2" bgcolor="%s" border="0" align="center"><font color="#444443" point-size="10">...</font></td>\n' % bgcolor
+    cell = '<td cellspacing="0" cellpadding="3" bgcolor="%s" border="0" align="center"><font color="#444443" point-size="10">%%s</font></td>\n' % bgcolor
     rows = []
     for i in range(nrows):
-        if rowoversize and i==midpoint:
-            rows.append( '<tr><td bgcolor="%s" cellpadding="2" border="0" align="center"><font color="#444443" point-size="10">&#8942;</font></td><td bgcolor="%s" cellpadding="2" border="0" colspan="%d"></td></tr>\n' % (bgcolor,bgcolor,ncols))
-        cells = []
-        for j in range(ncols):
-            if coloversize and j==midpoint:
-                cells.append( '<td cellspacing="0" cellpadding="2" bgcolor="%s" border="0" align="center"><font color="#444443" point-size="10">...</font></td>\n' % bgcolor)
-            value = data[i,j]
-            if isinstance(value, float):
-                if str(value).endswith('.0'):
-                    value = str(value)[:-1]
-                else:
-                    value = round(value, prefs.float_precision)
-            if len(str(value)) > prefs.max_str_len:
-                value = abbrev_and_escape(str(value))
-            cell = '<td cellspacing="0" cellpadding="3" bgcolor="%s" border="0" align="center"><font color="#444443" point-size="10">%s</font></td>\n' % (bgcolor, value)
-            cells.append( cell )
-        row = '<tr>' + ''.join(cells) + '</tr>\n'
-        rows.append(row)
+        cells = [cell % value for value in values[i]]
+        if coloversize:
+            cells.insert(midpoint, ellipsis)
+        rows.append('<tr>' + ''.join(cells) + '</tr>\n')
+    if rowoversize:
+        rows.insert(midpoint, '<tr><td bgcolor="%s" cellpadding="2" border="0" align="center"><font color="#444443" point-size="10">&#8942;</font></td><td bgcolor="%s" cellpadding="2" border="0" colspan="%d"></td></tr>\n' % (bgcolor,bgcolor,ncols))
 
     return header + ''.join(rows) + tail
 
 
+def corner_slices(n):
+    """
+    Return ([slice,...], oversize) selecting the positions of an axis of
+    length n to display: all of them or the first and last few.
+    """
+    midpoint = prefs.max_list_elems//2
+    if n > prefs.max_list_elems:
+        return [slice(0,midpoint), slice(n-midpoint,n)], True
+    return [slice(0,n)], False
+
+
+def array_corners(data, index=()):
+    """
+    Cut the head and tail rows and columns we'll display out of a 1-D
+    or 2-D array, or out of the 1-D or 2-D slice data[index] of a bigger
+    one, using basic slices, which are views, and join just those pieces.
+    Only the displayed elements are read, so memory-mapped arrays aren't
+    paged in. Return (block, rowoversize, coloversize).
+    """
+    np = sys.modules['numpy']
+    shape = tuple(data.shape)[len(index):]
+    slices = corner_slices
+
+    if len(shape) == 0:
+        return np.asarray(data[index]).reshape(1), False, False
+
+    if len(shape) == 1:
+        cols, coloversize = slices(shape[0])
+        block = np.concatenate([np.asarray(data[index+(c,)]) for c in cols])
+        return block, False, coloversize
+
+    rows, rowoversize = slices(shape[0])
+    cols, coloversize = slices(shape[1])
+    block = np.concatenate([np.concatenate([np.asarray(data[index+(r,c)]) for c in cols], axis=1)
+                            for r in rows])
+    return block, rowoversize, coloversize
+
+
+def format_array(block):
+    """
+    Format all elements of a small array for display in one pass over
+    the block rather than element by element: floats are rounded to
+    prefs.float_precision with a trailing ".0" shortened to ".", long
+    values abbreviated to prefs.max_str_len chars, and text escaped.
+    Return an array of str the same shape as block.
+    """
+    np = sys.modules['numpy']
+    kind = block.dtype.kind
+    if kind in 'fc':
+        strs = np.round(block, prefs.float_precision).astype(str)
+        strs = np.where(np.char.endswith(strs, '.0'), np.char.rstrip(strs, '0'), strs)
+    elif kind == 'S':
+        strs = np.char.decode(block, 'latin-1')
+    elif kind == 'M': # datetimes at the coarsest unit that shows them exactly
+        strs = np.datetime_as_string(block, unit='auto')
+    elif kind in 'VO': # structured records, objects (which may be tuples)
+        strs = np.array([str(x) for x in block.flat], dtype=str).reshape(block.shape)
+    else: # ints, bools, dates, str
+        strs = block.astype(str)
+    if strs.size == 0:
+        return strs
+
+    if np.char.str_len(strs).max() > prefs.max_str_len:
+        toolong = np.char.str_len(strs) > prefs.max_str_len
+        abbrev = np.char.add(strs.astype('U%d' % prefs.max_str_len), '...')
+        strs = np.where(toolong, abbrev, strs)
+    if kind in 'USOV':
+        # np.char.replace can truncate when results grow, so escape in Python
+        escaped = [x.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;') for x in strs.flat]
+        strs = np.array(escaped, dtype=str).reshape(strs.shape)
+    return strs
+
+
+def gr_ndarray_html(data, bgcolor=YELLOW):
+    """
+    Show an array of any dimension. Arrays with more than 2 dimensions
+    become a stack of 2-D tables labeled by their leading indexes, with
+    at most prefs.max_ndarray_slices of them: the first and last few
+    with a vertical ellipsis between.
+    """
+    if 'numpy' not in sys.modules:
+        import numpy
+    np = sys.modules['numpy']
+    if not isarraylike(data):
+        return " "
+    shape = tuple(data.shape)
+    if len(shape) <= 2:
+        return gr_2darray_html(data, bgcolor)
+
+    lead = shape[:-2]
+    n = 1
+    for d in lead:
+        n *= d
+    midpoint = prefs.max_ndarray_slices//2
+    if n > prefs.max_ndarray_slices:
+        ks = list(range(midpoint)) + list(range(n-midpoint, n))
+    else:
+        ks = list(range(n))
+
+    header = '<table BORDER="0" CELLPADDING="0" CELLBORDER="0" CELLSPACING="2">\n'
+    tail = "</table>\n"
+    label = '<tr><td align="left"><font face="Helvetica" color="#444443" point-size="9">%s</font></td></tr>\n'
+
+    rows = [label % ('%s %s' % (data.dtype, shape))]
+    slices = []
+    for k in ks:
+        index = tuple(int(i) for i in np.unravel_index(k, lead))
+        title = '[' + ', '.join([str(i) for i in index]) + ', :, :]'
+        slices.append(label % title +
+                      '<tr><td>%s</td></tr>\n' % gr_2darray_html(data, bgcolor, index))
+    if len(ks) < n:
+        slices.insert(midpoint, '<tr><td align="left"><font color="#444443" point-size="10">&#8942; %d more</font></td></tr>\n' % (n-len(ks)))
+    return header + ''.join(rows + slices) + tail
+
+
 def gr_ndarray_node(nodename, data, bgcolor=YELLOW):
     shape="box"
-    html = gr_2darray_html(data, bgcolor=bgcolor)
+    html = gr_ndarray_html(data, bgcolor=bgcolor)
     return '%s [shape="%s", space="0.0", margin="0.01", fontcolor="#444443", fontname="Helvetica", label=<%s>];\n' % (nodename,shape,html)
 
 
+def gr_dataframe_node(nodename, df, bgcolor=YELLOW):
+    """Draw a pandas DataFrame or Series"""
+    html = gr_dataframe_html(df, bgcolor=bgcolor)
+    return '%s [shape="box", space="0.0", margin="0.01", fontcolor="#444443", fontname="Helvetica", label=<%s>];\n' % (nodename,html)
+
+
+def gr_dataframe_html(df, bgcolor=YELLOW):
+    """
+    Show the head and tail rows and columns of a pandas DataFrame, or a
+    Series as a one-column frame, with column names, dtypes and index
+    labels. Cells are pulled column by column with positional slices,
+    never through df.values, so the cost depends on the displayed cells
+    and not the size of the frame.
+    """
+    if 'numpy' not in sys.modules:
+        import numpy
+    np = sys.modules['numpy']
+    if isseries(df):
+        nrows, ncols = len(df), 1
+        column = lambda j: df
+        colname = lambda j: '' if df.name is None else df.name
+    else:
+        nrows, ncols = df.shape
+        column = lambda j: df.iloc[:, j]
+        colname = lambda j: df.columns[j]
+    rows, rowoversize = corner_slices(nrows)
+    cols, coloversize = corner_slices(ncols)
+    midpoint = prefs.max_list_elems//2
+
+    header = '<table BORDER="0" CELLPADDING="0" CELLBORDER="1" CELLSPACING="0">\n'
+    tail = "</table>\n"
+    ellipsis = '<td cellspacing="0" cellpadding="2" bgcolor="%s" border="0" align="center"><font color="#444443" point-size="10">...</font></td>\n' % bgcolor
+    cell = '<td cellspacing="0" cellpadding="3" bgcolor="%s" border="0" align="%%s"><font color="#444443" point-size="10">%%s</font></td>\n' % bgcolor
+    label = '<td cellspacing="0" cellpadding="3" border="0" align="%s"><font face="Helvetica" color="#444443" point-size="%s">%s</font></td>\n'
+
+    names = []
+    dtypes = []
+    columns = [] # (alignment, formatted head and tail values) of each displayed column
+    for c in cols:
+        for j in range(c.start, c.stop):
+            col = column(j)
+            names.append(label % ('center', 10, abbrev_and_escape(str(colname(j)))))
+            dtypes.append(label % ('center', 8, '<i>%s</i>' % abbrev_and_escape(str(col.dtype))))
+            values = np.concatenate([np.asarray(col.iloc[r].to_numpy()) for r in rows])
+            align = 'right' if values.dtype.kind in 'biufc' else 'left'
+            columns.append((align, format_array(values)))
+    if coloversize:
+        names.insert(midpoint, '<td></td>\n')
+        dtypes.insert(midpoint, '<td></td>\n')
+    index = np.concatenate([np.asarray(df.index[r]) for r in rows])
+    index = format_array(index) if len(index) > 0 else []
+
+    out = ['<tr><td></td>\n' + ''.join(names) + '</tr>\n',
+           '<tr><td></td>\n' + ''.join(dtypes) + '</tr>\n']
+    for i in range(len(index)):
+        cells = [label % ('right', 10, index[i])]
+        cells += [cell % (align, values[i]) for align, values in columns]
+        if coloversize:
+            cells.insert(midpoint+1, ellipsis)
+        out.append('<tr>' + ''.join(cells) + '</tr>\n')
+    if rowoversize:
+        out.insert(2+midpoint, '<tr><td bgcolor="%s" cellpadding="2" border="0" align="right"><font color="#444443" point-size="10">&#8942;</font></td><td bgcolor="%s" cellpadding="2" border="0" colspan="%d"></td></tr>\n' % (bgcolor,bgcolor,len(names)))
+
+    return header + ''.join(out) + tail
+
+
 def matrixviz(data):
-    s = """
+    return linear_source(write_matrixviz, data)
+
+
+def write_matrixviz(w, data):
+    w.write("""
     digraph G {
         nodesep=.05;
         node [penwidth="0.5", width=.1,height=.1];
-    """
+    """)
 
-    s += gr_ndarray_node('node%d'%id(data), data)
+    w.write(gr_ndarray_node('node%d'%id(data), data))
 
-    s += "}\n"
-    return graphviz.Source(s)
+    w.write("}\n")
 
 
 def islol(elems):
@@ -863,34 +2677,61 @@ def islol(elems):
     return True
 
 
+def isndarray(p):
+    "Is p a numpy array or subclass such as np.memmap? Doesn't import numpy."
+    return 'numpy' in sys.modules and isinstance(p, sys.modules['numpy'].ndarray)
+
+
+def isseries(p):
+    return 'pandas' in sys.modules and isinstance(p, sys.modules['pandas'].Series)
+
+
+def isdataframe(p):
+    return 'pandas' in sys.modules and isinstance(p, sys.modules['pandas'].DataFrame)
+
+
+def isarraylike(data):
+    "Does data slice like an array: a numpy array, memmap, h5py dataset, etc.?"
+    return hasattr(data, 'shape') and hasattr(data, 'dtype') and hasattr(data, '__getitem__')
+
+
 def isatomlist(elems):
     if type(elems)!=list and type(elems)!=tuple and type(elems)!=set:
         return False
     if len(elems)==0: # empty lists are not atom lists
         return False
-    for x in elems:
-        if not isatom(x):
-            return False
-    return True
+    return allatoms(elems)
+
+
+_atom_types = {int: True, float: True, str: True, WrapAssoc: True, Ellipsis: True, FrozenAtom: True}
+if sys.version_info < (3, 0):
+    _atom_types[unicode] = True # only python 2 distinguishes between str/unicode
 
 
 def isatom(p):
-    if (sys.version_info > (3, 0)):
-        return isatom_(p)
-    else:
-        return isatom_(p) or type(p) == unicode # only python 2 distinguishes between str/unicode
+    a = _atom_types.get(type(p))
+    if a is None:
+        a = isatomtype(type(p))
+    return a
 
 
-def isatom_(p):
-    if type(p).__module__ == 'numpy':
-        if 'numpy' not in sys.modules:
-            import numpy
-        np = sys.modules['numpy']
-        return np.isscalar(p)
-    return type(p) == int or type(p) == float or \
-                       type(p) == str or \
-                       p.__class__ == WrapAssoc or \
-                       p.__class__ == Ellipsis
+def isatomtype(t):
+    """Are objects of type t displayed as values? Decided once per type."""
+    a = _atom_types.get(t)
+    if a is None:
+        np = sys.modules.get('numpy') # numpy scalars can only exist once it's imported
+        a = np is not None and issubclass(t, np.generic)
+        _atom_types[t] = a
+    return a
+
+
+def allatoms(elems):
+    """
+    Are all elems atoms? Gathers the distinct element types in a single
+    pass at C speed and then checks each type once, so a long list of
+    ints, floats or numpy scalars costs no Python call per element.
+    """
+    return all([isatomtype(t) for t in set(map(type, elems))])
 
 
 def isplainobj(p): return type(p) != types.FrameType and \
@@ -899,58 +2740,446 @@ def isplainobj(p): return type(p) != types.FrameType and \
                           hasattr(p, "__dict__")
 
 
-def closure(p, varnames=None):
+class GraphNode:
     """
-    Find all nodes reachable from p and return a list of pointers to those reachable.
-    There can't be duplicates even for cyclic graphs due to visited set. Chase ptrs
-    from but don't include frame objects.
+    One object in an ObjGraph: its id(), type, the kind of node to draw,
+    a name (class, scope or value), the atom fields to display and the
+    outgoing edges as (port, id of target) pairs.
+    """
+    def __init__(self, p, kind, name, fields=None, edges=()):
+        self.obj = p
+        self.id = id(p)
+        self.type = type(p)
+        self.kind = kind
+        self.name = name
+        self.fields = fields
+        self.edges = edges
+        self.highlight = None
+        self.draw = None # draw(nodename, gnode) for kinds from register_handler()
+        self.dot = None  # DOT rendered ahead of time for nodes frozen into a Tracer step
+        self.size = None     # bytes of the object itself if prefs.show_sizes, see own_size()
+        self.more = 0        # entries of a dict or object left out of fields by prefs.max_dict_elems
+        self.retained = None # bytes freed if it were, see ObjGraph.measure()
+
+
+class ObjGraph:
+    """
+    Intermediate representation of everything reachable from one or more
+    roots, built with a single walk of the live objects: a table of
+    GraphNodes keyed by id() plus the non-frame nodes in closure order.
+    The DOT emitters draw from this rather than re-walking the objects.
+
+    To bound the work on huge heaps, the walk stops expanding once it
+    has max_nodes non-frame nodes or at objects more than max_depth
+    pointers away from a root (objects referenced by a frame are at
+    depth 1). An object first reached by a longer path is expanded
+    again when a shorter one turns up, so the cut depends only on its
+    distance. Pointers to objects left out lead nowhere in the graph;
+    truncated is set if the walk left anything out, even if a shorter
+    path took it in later.
+
+    If prefs.show_sizes, the walk also records each node's own_size().
+    """
+    def __init__(self, varnames=None, max_nodes=None, max_depth=None, caller=None):
+        self.varnames = varnames
+        self.max_nodes = max_nodes
+        self.max_depth = max_depth
+        self.caller = caller # don't walk up the stack into this frame
+        self.truncated = False
+        self.nodes = [] # GraphNodes of non-frame objects in closure order
+        self.index = {} # id(p) -> GraphNode for all objects visited, including frames
+        self.roots = [] # ids of the objects passed to add()
+        self.depths = None if max_depth is None else {} # id -> fewest pointers from a root
+        self.kids = None if max_depth is None else {} # id -> objects it points to
+
+    def add(self, p):
+        """
+        Record everything reachable from p not already in the graph.
+        The walk keeps an explicit stack of children iterators rather
+        than recursing so that long linked lists or deep trees can't
+        blow the Python stack, and stays linear in the graph size.
+        Chase ptrs from but don't include frame objects in nodes.
+        """
+        index = self.index
+        max_nodes = self.max_nodes
+        max_depth = self.max_depth
+        sizes = prefs.show_sizes
+        depths, kids = self.depths, self.kids
+        if p is not None and not isatom(p):
+            self.roots.append(id(p))
+        stack = [(iter([p]), 0)] # children iterator, depth of those children
+        while stack:
+            it, depth = stack[-1]
+            for q in it:
+                if q is None or isatom(q):
+                    continue
+                if id(q) in index:
+                    if depths is not None and depths.get(id(q), -1) > depth: # reached by a shorter path
+                        depths[id(q)] = depth
+                        stack.append((iter(kids[id(q)]), depth+1))
+                        break
+                    continue
+                isframe = type(q) == types.FrameType
+                if not isframe and \
+                   ((max_nodes is not None and len(self.nodes) >= max_nodes) or
+                    (max_depth is not None and depth > max_depth)):
+                    self.truncated = True # q might be reached later by a shorter path
+                    continue
+                gnode, refs = self.build(q)
+                index[gnode.id] = gnode
+                if sizes:
+                    gnode.size = own_size(q)
+                children = [r for _, r in refs]
+                if isframe:
+                    if gnode.name != '<module>' and q.f_back is not self.caller: # stop at globals
+                        stack.append((iter([q.f_back]), depth)) # after locals
+                else:
+                    self.nodes.append(gnode)
+                    if depths is not None:
+                        depths[gnode.id] = depth
+                        kids[gnode.id] = children
+                stack.append((iter(children), depth+1))
+                break
+            else: # no more children at this level
+                stack.pop()
+
+    def build(self, p):
+        if type(p) == types.FrameType:
+            return graph_node(p, self.varnames)
+        return graph_node(p)
+
+    def node(self, p):
+        """Return the GraphNode for p, building a standalone one if p wasn't reached"""
+        gnode = self.index.get(id(p))
+        if gnode is None:
+            gnode, _ = self.build(p)
+        return gnode
+
+    def measure(self):
+        """
+        Set the retained size of each node with a size: the bytes that
+        would be freed if it were, which is its own size plus the sizes
+        of the nodes it dominates (every path from a root or frame to
+        them goes through it). An object shared by two others is
+        retained by neither but by their common dominator, so it is
+        counted once. Uses the recorded edges, not the live objects.
+        """
+        index = self.index
+        if all(gnode.size is None or gnode.retained is not None for gnode in index.values()):
+            return
+        def targets(i):
+            return [j for _, j in index[i].edges if j in index]
+        roots = self.roots + [i for i, gnode in index.items() if gnode.kind == 'frame']
+
+        # Depth-first postorder from the roots; a dominator finishes after the nodes it dominates
+        order = [] # ids in postorder
+        number = {} # id -> position in order, None while on the stack
+        edges = [] # (from id, to id); 0 stands for a root above all the roots
+        for r in roots:
+            if r not in index or r in number:
+                continue
+            edges.append((0, r))
+            number[r] = None
+            stack = [(r, iter(targets(r)))]
+            while stack:
+                i, it = stack[-1]
+                for j in it:
+                    edges.append((i, j))
+                    if j not in number:
+                        number[j] = None
+                        stack.append((j, iter(targets(j))))
+                        break
+                else:
+                    stack.pop()
+                    number[i] = len(order)
+                    order.append(i)
+        top = len(order)
+        number[0] = top
+        preds = [[] for i in range(top)]
+        for i, j in edges:
+            preds[number[j]].append(number[i])
+
+        # Cooper, Harvey and Kennedy's iterative dominator algorithm on postorder numbers
+        idom = [None] * top + [top]
+        def intersect(a, b):
+            while a != b:
+                while a < b:
+                    a = idom[a]
+                while b < a:
+                    b = idom[b]
+            return a
+        changed = True
+        while changed:
+            changed = False
+            for n in range(top-1, -1, -1): # reverse postorder
+                new = None
+                for p in preds[n]:
+                    if idom[p] is not None:
+                        new = p if new is None else intersect(p, new)
+                if idom[n] != new:
+                    idom[n] = new
+                    changed = True
+
+        for gnode in index.values():
+            gnode.retained = gnode.size or 0
+        for n in range(top): # nodes before their dominators
+            if idom[n] != top:
+                index[order[idom[n]]].retained += index[order[n]].retained
+
+
+def as_objgraph(reachable, varnames=None):
+    """Return reachable if already an ObjGraph else build one from a list of objects"""
+    if isinstance(reachable, ObjGraph):
+        return reachable
+    graph = ObjGraph(varnames)
+    for p in reachable:
+        graph.add(p)
+    return graph
+
+
+def graph_node(p, varnames=None):
     """
-    return closure_(p, varnames, set())
+    Classify p and gather the atom fields to display and the pointers
+    out of p in one pass over its contents. Return (GraphNode, refs)
+    where refs is the list of (port, q) for all ptrs in p.
+    """
+    handler, draw = handler_of(type(p))
+    gnode, refs = handler(p, varnames)
+    gnode.edges = [(port, id(q)) for port, q in refs]
+    if draw is not None:
+        gnode.draw = draw
+    return gnode, refs
 
 
-def closure_(p, varnames, visited):
-    if p is None or isatom(p):
-        return []
-    if id(p) in visited:
-        return []
-    visited.add(id(p))
-    result = []
-    if type(p) != types.FrameType:
-        result.append(p)
+_node_handlers = {}  # concrete type -> (handler, draw); filled in by handler_of()
+_user_handlers = []  # (cls, handler, draw) from register_handler(), latest first
 
-    # now chase where we can reach
-    if type(p) == types.FrameType:
-        frame = p
-        info = inspect.getframeinfo(frame)
-        for k, v in frame.f_locals.items():
-            # error('INCLUDE frame var %s' % k)
-            if varnames is not None and k not in varnames: continue
-            if not ignoresym((k, v)):
-                cl = closure_(v, varnames, visited)
-                result.extend(cl)
-        caller_scopename = info[2]
-        if caller_scopename != '<module>': # stop at globals
-            cl = closure_(p.f_back, varnames, visited)
-            result.extend(cl)
-    elif type(p).__module__ == 'numpy' and type(p).__name__ == 'ndarray':
-        pass # ndarray added already above; don't chase its elements here
-    elif type(p).__module__ == 'pandas.core.series' and type(p).__name__ == 'Series':
-        pass  # pd.Series added already above; don't chase its elements here
-    elif type(p).__module__ == 'pandas.core.frame' and type(p).__name__ == 'DataFrame':
+
+def register_handler(cls, handler, draw=None):
+    """
+    Use handler(p, varnames) to build the graph node for objects of class
+    cls or its subclasses. It must return (GraphNode, refs) like
+    graph_node(), where refs lists (port, q) for each object q that p
+    points at. Give the node one of the built-in kinds such as 'object'
+    or 'atomlist', or pass draw(nodename, gnode) to return its DOT.
+    """
+    _user_handlers.insert(0, (cls, handler, draw))
+    _node_handlers.clear()
+
+
+def handler_of(t):
+    """Return (handler, draw) for objects of type t, deciding once per type"""
+    try:
+        return _node_handlers[t]
+    except KeyError:
         pass
-    elif type(p)==dict:
-        for k,q in p.items():
-            cl = closure_(q, varnames, visited)
-            result.extend(cl)
-    elif hasattr(p, "__dict__"): # regular object like Tree or Node
-        for k,q in p.__dict__.items():
-            cl = closure_(q, varnames, visited)
-            result.extend(cl)
-    elif hasattr(p, "__iter__"): # a list or similar
-        for q in p:
-            cl = closure_(q, varnames, visited)
-            result.extend(cl)
-    return result
+    for cls, handler, draw in _user_handlers:
+        if issubclass(t, cls):
+            break
+    else:
+        handler, draw = builtin_handler(t), None
+    _node_handlers[t] = (handler, draw)
+    return handler, draw
+
+
+def builtin_handler(t):
+    if t == types.FrameType: return frame_graph_node
+    if issubclass(t, dict): return dict_graph_node
+    if issubclass(t, set): return set_graph_node
+    if t == bool: return bool_graph_node
+    # numpy and pandas types can only exist once those are imported
+    np, pd = sys.modules.get('numpy'), sys.modules.get('pandas')
+    if np is not None and issubclass(t, np.ndarray): return ndarray_graph_node
+    if pd is not None and issubclass(t, pd.Series): return series_graph_node
+    if pd is not None and issubclass(t, pd.DataFrame): return dataframe_graph_node
+    if issubclass(t, list): return list_graph_node
+    if hasattr(t, "__iter__"): return iter_graph_node
+    return plain_graph_node
+
+
+def frame_graph_node(frame, varnames=None):
+    refs = []
+    code = frame.f_code
+    # positional and keyword-only parameters lead co_varnames
+    argnames = code.co_varnames[:code.co_argcount + getattr(code, 'co_kwonlyargcount', 0)]
+    f_locals = frame.f_locals
+    items = []
+    # do args first to get proper order
+    for arg in argnames:
+        if varnames is not None and arg not in varnames: continue
+        v = f_locals[arg]
+        if isatom(v):
+            items.append((arg, arg, v))
+        else:
+            items.append((arg, arg, None))
+    for k, v in f_locals.items():
+        if varnames is not None and k not in varnames: continue
+        if ignoresym((k, v)):
+            continue
+        if not isatom(v) and v is not None:
+            refs.append((k, v))
+        if k in argnames:
+            continue
+        if isatom(v):
+            items.append((k, k, v))
+        else:
+            items.append((k, k, None))
+    gnode = GraphNode(frame, 'frame', code.co_name, items)
+    gnode.highlight = argnames
+    return gnode, refs
+
+
+def dict_graph_node(p, varnames=None):
+    refs = []
+    items = []
+    if varnames is None:
+        entries = dict_sample(p) # only what's displayed gets a row and edges
+        more = len(p) - len(entries)
+    else:
+        entries = [(i, k, v) for i, (k, v) in enumerate((k, v) for k, v in p.items() if k in varnames)]
+        more = 0
+    for i, k, v in entries:
+        if isatom(v):
+            items.append((str(i), k, v))
+        else:
+            items.append((str(i), k, None))
+            if v is not None:
+                refs.append((str(i), v))
+    gnode = GraphNode(p, 'dict', None, items)
+    gnode.more = more
+    return gnode, refs
+
+
+def set_graph_node(p, varnames=None):
+    if len(p) == 0:  # special case "empty set"
+        return GraphNode(p, 'emptyset', None), []
+    return iter_graph_node(p, varnames)
+
+
+def bool_graph_node(p, varnames=None):
+    return GraphNode(p, 'bool', str(p)), []
+
+
+def ndarray_graph_node(p, varnames=None):
+    return GraphNode(p, 'ndarray', None), [] # don't chase elements
+
+
+def series_graph_node(p, varnames=None):
+    return GraphNode(p, 'series', None), []
+
+
+def dataframe_graph_node(p, varnames=None):
+    return GraphNode(p, 'dataframe', None), []
+
+
+def list_graph_node(p, varnames=None):
+    if len(p) == 0: # special case "empty list"
+        return GraphNode(p, 'emptylist', None), []
+    return iter_graph_node(p, varnames)
+
+
+def iter_graph_node(p, varnames=None):
+    if type(p) in (list, tuple, set) and allatoms(p):
+        kind = 'atomset' if isinstance(p,set) else 'atomlist'
+        return GraphNode(p, kind, None, ListSample(p)), []
+    refs = []
+    elems = []
+    for i, el in enumerate(p):
+        if isatom(el):
+            elems.append(el)
+        else:
+            elems.append(None)
+            if el is not None:
+                refs.append((str(i), el))
+    if type(p)==tuple or (len(refs)==0 and isatomlist(p)):
+        kind = 'atomset' if isinstance(p,set) else 'atomlist'
+        elems = ListSample(elems) # keep only what's displayed
+    else:
+        kind = 'vset' if isinstance(p,set) else 'vlist'
+    return GraphNode(p, kind, None, elems), refs
+
+
+def plain_graph_node(p, varnames=None):
+    if not hasattr(p, "__dict__"):
+        return GraphNode(p, 'other', type(p).__name__), []
+    # regular object like Tree or Node
+    refs = []
+    items = []
+    entries = dict_sample(p.__dict__)
+    for i, k, v in entries:
+        if isatom(v):
+            items.append((k, k, v))
+        else:
+            items.append((k, k, None))
+            if v is not None:
+                refs.append((k, v))
+    gnode = GraphNode(p, 'object', p.__class__.__name__, items)
+    gnode.more = len(p.__dict__) - len(entries)
+    return gnode, refs
+
+
+def own_size(p):
+    """
+    Bytes used by p as sys.getsizeof() counts them, plus its instance
+    __dict__ and the atoms (strings, numbers, ...) it holds, since those
+    are drawn inside p's node rather than as nodes of their own.
+    """
+    size = sys.getsizeof(p, 0)
+    if type(p) == types.FrameType:
+        return size
+    if isinstance(p, dict):
+        held = list(p.keys()) + list(p.values())
+    elif isinstance(p, (list, tuple, set, frozenset)):
+        held = p
+    elif isinstance(getattr(p, '__dict__', None), dict):
+        size += sys.getsizeof(p.__dict__, 0)
+        held = p.__dict__.values()
+    else:
+        return size
+    return size + sum(sys.getsizeof(v, 0) for v in held if v is not None and isatom(v))
+
+
+def format_size(n):
+    for unit in ('B', 'KB', 'MB'):
+        if n < 1024:
+            return '%d %s' % (n, unit) if unit == 'B' else '%.1f %s' % (n, unit)
+        n /= 1024.0
+    return '%.1f GB' % n
+
+
+_heat_colors = ("#ffffb2", "#fecc5c", "#fd8d3c", "#f03b20", "#bd0026") # light to dark by retained size
+
+def write_sizes(w, graph):
+    """
+    Label each node of graph that has a size with its size and retained
+    size. If prefs.size_heatmap, also color its border by its retained
+    size relative to the largest. Redeclaring a node adds attributes to it.
+    """
+    without_gc(graph.measure)
+    sized = [gnode for gnode in graph.index.values() if gnode.size is not None]
+    if not sized:
+        return
+    biggest = max(gnode.retained for gnode in sized) or 1
+    for gnode in sized:
+        label = format_size(gnode.size)
+        if gnode.retained > gnode.size:
+            label += ', retains ' + format_size(gnode.retained)
+        heat = ''
+        if prefs.size_heatmap:
+            color = _heat_colors[min(len(_heat_colors)-1, int(len(_heat_colors) * gnode.retained / float(biggest)))]
+            heat = ', color="%s", penwidth=2' % color
+        w.write('node%d [xlabel="%s", fontsize=9%s];\n' % (gnode.id, label, heat))
+
+
+def closure(p, varnames=None):
+    """
+    Find all nodes reachable from p and return a list of pointers to those reachable.
+    There can't be duplicates even for cyclic graphs due to visited set. Chase ptrs
+    from but don't include frame objects.
+    """
+    graph = ObjGraph(varnames)
+    graph.add(p)
+    return [gnode.obj for gnode in graph.nodes]
 
 
 def edges(reachable, varnames=None):
@@ -963,87 +3192,108 @@ def edges(reachable, varnames=None):
 
 def node_edges(p, varnames=None):
     """Return list of (p, fieldname-in-p, q) for all ptrs in p"""
-    edges = []
-    if type(p) == types.FrameType:
-        frame = p
-        for k, v in frame.f_locals.items():
-            if varnames is not None and k not in varnames: continue
-            if not ignoresym((k, v)) and not isatom(v) and v is not None:
-                edges.append((frame, k, v))
-    elif type(p) == dict:
-        i = 0
-        for k, v in p.items():
-            if not isatom(v) and v is not None:
-                edges.append((p, str(i), v))
-            i += 1
-    elif type(p).__module__ == 'numpy' and type(p).__name__ == 'ndarray':
-        pass # don't chase elements
-    elif hasattr(p, "__iter__"):
-        for i, el in enumerate(p):
-            if not isatom(el) and el is not None:
-                edges.append((p, str(i), el))
-    elif hasattr(p, "__dict__"):
-        for k, v in p.__dict__.items():
-            if not isatom(v) and v is not None:
-                edges.append((p, k, v))
-    return edges
+    _, refs = graph_node(p, varnames)
+    return [(p, port, q) for port, q in refs]
 
 
 def viz_exists_for_object(p):
-    if type(p) == types.FrameType: return True
-    if isinstance(p,dict): return True
-    elif isinstance(p,set) and len(p) == 0: return True
-    elif p is True or p is False: return True
-    elif type(p).__module__ == 'numpy' and type(p).__name__ == 'ndarray': return True
-    elif type(p).__module__ == 'pandas.core.series' and type(p).__name__ == 'Series': return True
-    elif type(p).__module__ == 'pandas.core.frame' and type(p).__name__ == 'DataFrame': return True
-    return False
+    handler, draw = handler_of(type(p))
+    if draw is not None or any(issubclass(type(p), cls) for cls, _, _ in _user_handlers): return True
+    if handler in (frame_graph_node, dict_graph_node, bool_graph_node, ndarray_graph_node,
+                   series_graph_node, dataframe_graph_node, list_graph_node): return True
+    return handler is set_graph_node and len(p) == 0
 
 
 def connected_subgraphs(reachable, varnames=None):
     """
-    Find all connected subgraphs of same type and same fieldname. Return a list
-    of sets containing the id()s of all nodes in a specific subgraph
+    Find all connected subgraphs of same type and same fieldname. Return
+    the max_edges_in_connected_subgraphs() mapping and a list of lists
+    containing the objects in each subgraph.
+    """
+    max_edges_for_type, subgraphs, _ = graph_subgraphs(as_objgraph(reachable, varnames))
+    return max_edges_for_type, [[gnode.obj for gnode in g] for g in subgraphs]
+
+
+def graph_subgraphs(graph):
+    """
+    connected_subgraphs() for an ObjGraph. Same-type nodes are merged
+    with a DisjointSets so the work stays near-linear in the number of
+    edges. Return (max_edges_for_type, subgraphs, cluster_of) where the
+    subgraphs are lists of GraphNodes in closure order, ordered by first
+    member, and cluster_of maps the id() of every node in a subgraph to
+    its index in subgraphs.
     """
-    max_edges_for_type = max_edges_in_connected_subgraphs(reachable, varnames)
+    max_edges_for_type = graph_max_edges(graph)
 
-    reachable = closure(reachable, varnames)
-    reachable = [p for p in reachable if isplainobj(p)]
-    subgraphs = [] # list of sets of obj id()s
-    subgraphobjs = [] # list of sets of obj ptrs (parallel list to track objs since can't hash on some objs like lists/sets as keys)
+    sets = DisjointSets()
     type_fieldname_map = {}
-    for p in reachable:
-        edges = node_edges(p, varnames)
-        for e in edges:
-            fieldname = e[1]
-            q = e[2]
-            if type(p) == type(q):
+    for p in graph.nodes:
+        if p.kind != 'object':
+            continue
+        for fieldname, qid in p.edges:
+            q = graph.index.get(qid)
+            if q is not None and p.type == q.type:
                 # ensure that singly-linked nodes use same field
-                cname = p.__class__.__name__
-                if max_edges_for_type[p.__class__]==1 and cname in type_fieldname_map:
+                cname = p.name
+                if max_edges_for_type[p.type]==1 and cname in type_fieldname_map:
                     prev_fieldname = type_fieldname_map[cname]
                     if fieldname!=prev_fieldname:
                         continue
                 else:
                     type_fieldname_map[cname] = fieldname
-                # search for an existing subgraph
-                found = False
-                for i in range(len(subgraphs)):
-                    g = subgraphs[i]
-                    go = subgraphobjs[i]
-                    if id(p) in g or id(q) in g:
-                        found = True
-                        g.update({id(p), id(q)})
-                        go.extend([p, q])
-                if not found:
-                    subgraphs.append({id(p),id(q)})
-                    subgraphobjs.append([p, q])
-
-    uniq = []
-    for g in subgraphobjs:
-        uniq.append( list(set(g)) )
-
-    return max_edges_for_type,uniq
+                sets.union(p.id, q.id)
+
+    subgraphs = []
+    cluster_of = {}
+    root_cluster = {}
+    for p in graph.nodes:
+        if p.id not in sets:
+            continue
+        root = sets.find(p.id)
+        c = root_cluster.get(root)
+        if c is None:
+            c = root_cluster[root] = len(subgraphs)
+            subgraphs.append([])
+        subgraphs[c].append(p)
+        cluster_of[p.id] = c
+
+    return max_edges_for_type, subgraphs, cluster_of
+
+
+class DisjointSets:
+    """
+    Union-find over object id()s with path compression and union by
+    size. Only ids passed to union() are members.
+    """
+    def __init__(self):
+        self.parent = {}
+        self.size = {}
+
+    def __contains__(self, x):
+        return x in self.parent
+
+    def find(self, x):
+        parent = self.parent
+        root = x
+        while parent[root] != root:
+            root = parent[root]
+        while parent[x] != root: # compress path
+            parent[x], x = root, parent[x]
+        return root
+
+    def union(self, x, y):
+        for z in (x, y):
+            if z not in self.parent:
+                self.parent[z] = z
+                self.size[z] = 1
+        x = self.find(x)
+        y = self.find(y)
+        if x == y:
+            return
+        if self.size[x] < self.size[y]:
+            x, y = y, x
+        self.parent[y] = x
+        self.size[x] += self.size[y]
 
 
 def max_edges_in_connected_subgraphs(reachable, varnames=None):
@@ -1058,14 +3308,23 @@ def max_edges_in_connected_subgraphs(reachable, varnames=None):
     Max == 1 indicates possible linked list
     whereas max == 2 indicates possible binary tree.
     """
+    return graph_max_edges(as_objgraph(reachable, varnames))
+
+
+def graph_max_edges(graph):
+    """max_edges_in_connected_subgraphs() for an ObjGraph"""
     max_edges_for_type = defaultdict(int)
-    reachable = closure(reachable, varnames)
-    reachable = [p for p in reachable if isplainobj(p)]
-    for p in reachable:
-        homo_edges = edges_to_same_type(p, varnames)
-        m = len(homo_edges)
+    index = graph.index
+    for p in graph.nodes:
+        if p.kind != 'object':
+            continue
+        m = 0
+        for _, qid in p.edges:
+            q = index.get(qid)
+            if q is not None and q.type == p.type:
+                m += 1
         if m>0:
-            max_edges_for_type[p.__class__] = max(max_edges_for_type[p.__class__], m)
+            max_edges_for_type[p.type] = max(max_edges_for_type[p.type], m)
 
     return max_edges_for_type
 
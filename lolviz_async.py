@@ -0,0 +1,133 @@
+"""
+asyncio versions of the lolviz entry points for use inside event-loop
+services such as notebook servers and dashboards. Graphs are built in
+the loop's default executor and laid out by graphviz run as an asyncio
+subprocess, so neither blocks the loop. Requires Python 3.
+
+    import lolviz_async
+    g = await lolviz_async.objviz(data)
+    svg = await lolviz_async.pipe(g, timeout=10)
+
+Layouts share lolviz.render_cache with the synchronous functions.
+"""
+import asyncio
+import functools
+import subprocess
+import sys
+
+import lolviz as lv
+
+
+async def build(viz, *args, **kwargs):
+    """
+    Call lolviz function viz(*args, **kwargs) in the default executor and
+    return its result. It runs under the caller's lolviz.settings().
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, functools.partial(lv.with_current_prefs(viz), *args, **kwargs))
+
+
+async def objviz(o, orientation="LR", max_nodes=None, max_depth=None):
+    return await build(lv.objviz, o, orientation, max_nodes, max_depth)
+
+
+async def listviz(elems, showassoc=True):
+    return await build(lv.listviz, elems, showassoc)
+
+
+async def lolviz(table, showassoc=True):
+    return await build(lv.lolviz, table, showassoc)
+
+
+async def treeviz(root, leftfield='left', rightfield='right'):
+    return await build(lv.treeviz, root, leftfield, rightfield)
+
+
+async def strviz(astring, start=None, stop=None, showhex=False, wrap=None):
+    return await build(lv.strviz, astring, start, stop, showhex, wrap)
+
+
+async def matrixviz(data):
+    return await build(lv.matrixviz, data)
+
+
+async def ndarrayviz(data):
+    return await build(lv.ndarrayviz, data)
+
+
+async def callsviz(callstack=None, varnames=None, max_nodes=None, max_depth=None):
+    """
+    Frames only hold their values while they run, so the stack is copied
+    with lolviz.stack_snapshot() on the loop and drawn in the executor.
+    """
+    if callstack is None:
+        callstack = lv.caller_frames(sys._getframe(1))
+    snap = lv.stack_snapshot(callstack, varnames, max_nodes, max_depth)
+    return await build(snap.source)
+
+
+async def callviz(frame=None, varnames=None, max_nodes=None, max_depth=None):
+    if frame is None:
+        frame = sys._getframe(1)
+    return await callsviz([frame], varnames, max_nodes, max_depth)
+
+
+async def pipe(source, format='svg', engine=None, timeout=None):
+    """
+    Lay out a graphviz Source (or DOT string) and return the output as
+    bytes. Raise asyncio.TimeoutError if it takes more than timeout
+    seconds and subprocess.CalledProcessError if graphviz fails. On
+    timeout or cancellation the graphviz process is killed.
+    """
+    if isinstance(source, str):
+        source = lv.CachedSource(source)
+    elif not isinstance(source, lv.CachedSource):
+        source = lv.CachedSource(source.source, engine=source.engine)
+    engine = engine or source.engine
+    data = source.inline_svg(format, engine)
+    if data is not None: # drawn without dot in well under a millisecond
+        return data
+    cache = lv.render_cache
+    key = source.cache_key(format, engine) # the same key as source.pipe(format, engine=engine)
+    data = await cache_io(cache.get, key)
+    if data is not None:
+        return data
+
+    cmd = [engine, '-T%s' % format]
+    proc = await asyncio.create_subprocess_exec(*cmd, stdin=subprocess.PIPE,
+                                                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    try:
+        data, err = await asyncio.wait_for(proc.communicate(source.source.encode('utf-8')), timeout)
+    except BaseException: # timed out or cancelled
+        if proc.returncode is None:
+            try:
+                proc.kill()
+            except ProcessLookupError:
+                pass
+            await proc.wait()
+        raise
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, cmd, data, err)
+    await cache_io(cache.put, key, data)
+    return data
+
+
+async def render(source, filename, format='svg', engine=None, timeout=None):
+    """Lay out source as with pipe() and write the output to filename, which is returned"""
+    data = await pipe(source, format, engine, timeout)
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, write_file, filename, data)
+    return filename
+
+
+def write_file(filename, data):
+    with open(filename, 'wb') as f:
+        f.write(data)
+
+
+async def cache_io(f, *args):
+    """Memory-only cache lookups are quick; ones that may touch disk go to the executor"""
+    if lv.render_cache.directory is None:
+        return f(*args)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, functools.partial(f, *args))
@@ -5,7 +5,7 @@ setup(
     version='1.4.4',
     url='https://github.com/parrt/lolviz',
     license='BSD',
-    py_modules=['lolviz'],
+    py_modules=['lolviz', 'lolviz_async'],
     author='Terence Parr',
     author_email='parrt@antlr.org',
     install_requires=['graphviz'], # needs numpy if you use ndarrayviz()
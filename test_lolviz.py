@@ -0,0 +1,25 @@
+import lolviz as lv
+from lolviz import *
+
+
+class Bag:
+    def __init__(self, *items):
+        self.items = list(items)
+
+    def __iter__(self):
+        return iter(self.items)
+
+
+def bag_node(bag, varnames=None):
+    return GraphNode(bag, 'atomlist', None, ListSample(['bag'] + bag.items)), []
+
+
+def test_handler_used_for_iterable_root():
+    register_handler(Bag, bag_node)
+    try:
+        assert "'bag'" in objviz(Bag(1, 2)).source
+        snap = snapshot(Bag(1, 2))
+        assert [gnode.type for gnode in snap.graph().nodes] == ['test_lolviz.Bag']
+    finally:
+        lv._user_handlers.remove((Bag, bag_node, None))
+        lv._node_handlers.clear()